@@ -0,0 +1,86 @@
+"""
+Measures the records/s of the firehose default processor transform on a 6 MB invocation,
+comparing the full json parse (the previous implementation) with the spliced fast path.
+
+    PYTHONPATH=src python benchmarks/default_processor.py
+"""
+import base64
+import json
+import os
+import time
+from uuid import uuid4
+
+# the processor creates its glue client at import, no call is made while benchmarking
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+from data import default_processor # pylint: disable=wrong-import-position
+
+# pylint: disable=invalid-name, line-too-long
+
+INVOCATION_BYTES = 6 * 1024 * 1024
+ROUNDS = 5
+
+
+def make_event(size: int = INVOCATION_BYTES) -> dict:
+    """
+    Builds a firehose processor event with json object records summing up to size bytes
+    """
+    records: list = []
+    total = 0
+    while total < size:
+        payload = json.dumps({
+            'id': str(uuid4()),
+            'type': 'page_view',
+            'timestamp': int(time.time() * 1000),
+            'user': {'id': len(records), 'segment': 'organic', 'tags': ['a', 'b', 'c']},
+            'properties': {f'property_{idx}': 'x' * 16 for idx in range(16)}
+        }).encode('utf-8')
+        data = base64.b64encode(payload).decode('utf-8')
+        records.append({
+            'recordId': str(uuid4()),
+            'approximateArrivalTimestamp': int(time.time() * 1000),
+            'data': data
+        })
+        total += len(data)
+    return {'records': records}
+
+
+def full_parse(firehose_record: dict) -> dict:
+    """
+    The transform as it was before the fast path, without its per record X-Ray subsegment
+    """
+    data = json.loads(base64.b64decode(firehose_record['data']))
+    data['firehose'] = {
+        'record_id': firehose_record['recordId'],
+        'timestamp': firehose_record['approximateArrivalTimestamp']
+    }
+    return {
+        'recordId': firehose_record['recordId'],
+        'result': 'Ok',
+        'data': base64.b64encode(json.dumps(data).encode("utf-8")).decode('utf-8')
+    }
+
+
+def measure(transform, records: list) -> float:
+    """
+    Returns the best records/s out of ROUNDS runs
+    """
+    best = 0.0
+    for _ in range(ROUNDS):
+        start = time.perf_counter()
+        for record in records:
+            transform(record)
+        best = max(best, len(records) / (time.perf_counter() - start))
+    return best
+
+
+def main():
+    records = make_event()['records']
+    before = measure(full_parse, records)
+    after = measure(default_processor.transform, records)
+    print(f'{len(records)} records per 6 MB invocation')
+    print(f'before: {before:,.0f} records/s')
+    print(f'after:  {after:,.0f} records/s ({after / before:.1f}x)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,262 @@
+"""
+Local stand-in for the completion driven linking: replays the sample Athena query state change through the
+partitions linker, as the control stream delivers it, with the S3 and DynamoDB clients replaced by in memory stubs.
+Checks that the compaction of the succeeded query, and only that one, is linked: the symlink manifest lists the
+previous and new compacted outputs then the objects past the cutoff, and the lease of the query is released.
+Replaying the event again, as the CloudTrail event of the tmp table does, changes nothing.
+
+    PYTHONPATH=src python events/link_query.py
+"""
+import base64
+import json
+import os
+import re
+import sys
+from datetime import datetime, timezone
+
+# no call reaches AWS, the clients created at import are replaced below
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.setdefault('AWS_XRAY_SDK_ENABLED', 'false')
+os.environ.setdefault('TMP_DATABASE', 'tmp')
+os.environ.setdefault('COMPACTED_PARTITIONS', 'compacted-partitions')
+os.environ.setdefault('ATHENA_QUERIES', 'athena-queries')
+from lib import athena, compactions, manifests, s3 # pylint: disable=wrong-import-position
+from control import partitions_linker # pylint: disable=wrong-import-position
+
+# pylint: disable=invalid-name, line-too-long, unused-argument, eval-used
+
+EVENT = os.path.join(os.path.dirname(__file__), 'athena_query_succeeded.json')
+PARTITION = 'dt=2019-10-17'
+OTHER_PARTITION = 'dt=2019-10-16'
+
+
+class ConditionalCheckFailedException(Exception):
+    pass
+
+
+class StubTable:
+    """
+    Serves the items of a dynamodb table by key, or by the execution id of the execution-index,
+    and applies the SET, REMOVE and ADD updates of the linker under their condition expression
+    """
+    def __init__(self, key: str, items: list):
+        self.key = key
+        self.items = {item[key]: item for item in items}
+
+    def get_item(self, Key: dict, **kwargs) -> dict:
+        item = self.items.get(Key[self.key])
+        return {'Item': dict(item)} if item else {}
+
+    def query(self, **kwargs) -> dict:
+        execution_id = kwargs['KeyConditionExpression'].get_expression()['values'][1]
+        return {'Items': [item for item in self.items.values() if item.get('execution_id') == execution_id]}
+
+    def update_item(self, Key: dict, UpdateExpression: str, ConditionExpression: str = None, ExpressionAttributeNames: dict = None, ExpressionAttributeValues: dict = None, **kwargs) -> dict:
+        names = ExpressionAttributeNames or {}
+        values = ExpressionAttributeValues or {}
+        item = dict(self.items.get(Key[self.key]) or Key)
+        if ConditionExpression and not evaluate(ConditionExpression, item, names, values):
+            raise ConditionalCheckFailedException(ConditionExpression)
+        for action, clause in re.findall(r'(SET|REMOVE|ADD) (.*?)(?= SET | REMOVE | ADD |$)', UpdateExpression):
+            for operation in clause.split(', '):
+                if action == 'SET':
+                    name, value = operation.split(' = ')
+                    item[names[name]] = values[value]
+                elif action == 'REMOVE':
+                    item.pop(names[operation], None)
+                else:
+                    name, value = operation.split(' ')
+                    current = item.get(names[name])
+                    item[names[name]] = (current | values[value]) if isinstance(values[value], set) else (current or 0) + values[value]
+        self.items[Key[self.key]] = item
+        return {'Attributes': dict(item)}
+
+
+def evaluate(condition: str, item: dict, names: dict, values: dict) -> bool:
+    """
+    Evaluates the comparisons and attribute_exists functions of a condition expression on an item
+    """
+    expression = re.sub(r'attribute_(not_)?exists\((#\w+)\)', lambda match: f"({'not ' if match[1] else ''}has('{match[2]}'))", condition)
+    expression = re.sub(r"(?<!')#\w+", lambda match: f"get('{match[0]}')", expression)
+    expression = re.sub(r':\w+', lambda match: f"value('{match[0]}')", expression)
+    expression = re.sub(r'(?<![<>!=])=(?!=)', '==', expression.replace(' AND ', ' and ').replace(' OR ', ' or ').replace('<>', '!='))
+    return eval(expression, {
+        'has': lambda name: names[name] in item,
+        'get': lambda name: item.get(names[name]),
+        'value': lambda name: values[name]
+    })
+
+
+class StubDynamoDB:
+    """
+    A dynamodb resource with stub tables
+    """
+    class meta: # pylint: disable=too-few-public-methods
+        class client: # pylint: disable=too-few-public-methods
+            class exceptions: # pylint: disable=too-few-public-methods
+                ConditionalCheckFailedException = ConditionalCheckFailedException
+
+    def __init__(self, tables: dict):
+        self.tables = tables
+
+    def Table(self, name: str) -> StubTable:
+        return self.tables[name]
+
+
+class StubS3:
+    """
+    An s3 client listing and writing objects in memory
+    """
+    def __init__(self, objects: dict):
+        self.objects = dict(objects)
+        self.puts: list = []
+
+    def list_objects_v2(self, Bucket: str, Prefix: str, **kwargs) -> dict:
+        contents = [
+            {'Key': key, 'Size': len(body), 'LastModified': modified}
+            for (bucket, key), (body, modified) in sorted(self.objects.items()) if bucket == Bucket and key.startswith(Prefix)
+        ]
+        return {'Contents': contents} if contents else {}
+
+    def put_object(self, Body, Bucket: str, Key: str) -> dict:
+        self.objects[(Bucket, Key)] = (Body, datetime.now(timezone.utc))
+        self.puts.append(Key)
+        return {}
+
+    def read(self, location: str) -> str:
+        bucket, key = location[len('s3://'):].split('/', 1)
+        return self.objects[(bucket, key)][0]
+
+
+class StubGlue:
+    """
+    A glue client recording the deleted tmp tables
+    """
+    def __init__(self):
+        self.deleted: list = []
+
+    def delete_table(self, DatabaseName: str, Name: str):
+        self.deleted.append(f'{DatabaseName}.{Name}')
+
+
+class Context:
+    aws_request_id = 'link-query-stand-in'
+
+
+def at(minute: int) -> datetime:
+    return datetime(2019, 10, 17, 10, minute, tzinfo=timezone.utc)
+
+
+def transaction(tmptable: str, partition: str) -> dict:
+    """
+    A compaction transaction as logged by the partitions compactor, compacting a delta after a first generation
+    """
+    name = tmptable.split('.', 1)[1]
+    return {
+        'tmptable': tmptable,
+        'partitions': [{
+            'target': f's3://data/firehose/events/compacted=2/{name}/{partition}',
+            'location': f's3://data/events/{partition}/symlink.txt',
+            'source': f's3://data/firehose/events/{partition}',
+            'outputs': [f's3://data/firehose/events/compacted=1/tmp0/{partition}'],
+            'cutoff': at(5).isoformat(),
+            'cutoff_keys': [f'firehose/events/{partition}/f1'],
+            'previous_cutoff': at(0).isoformat()
+        }]
+    }
+
+
+def generations(tmptable: str, partition: str) -> dict:
+    """
+    The compaction state of a partition whose compaction is running in the query writing tmptable
+    """
+    return {
+        'tmptable': f's3://data/events/{partition}/symlink.txt',
+        'source': f's3://data/firehose/events/{partition}',
+        'outputs': [f's3://data/firehose/events/compacted=1/tmp0/{partition}'],
+        'cutoff': at(0).isoformat(),
+        'cutoff_keys': [f'firehose/events/{partition}/f0'],
+        'objects': {f's3://data/firehose/events/{partition}/f1'},
+        'manifest_version': 3,
+        'running': tmptable,
+        'running_until': '2019-10-17T11:00:00'
+    }
+
+
+def replay(event: dict):
+    partitions_linker.handler({'Records': [to_kinesis_record(event)]}, Context())
+
+
+def to_kinesis_record(event: dict) -> dict:
+    """
+    Wraps an EventBridge event as the control stream delivers it, partitioned on its source
+    """
+    return {
+        'kinesis': {
+            'partitionKey': event['source'],
+            'sequenceNumber': '1',
+            'data': base64.b64encode(json.dumps(event).encode('utf-8')).decode('utf-8')
+        }
+    }
+
+
+def main() -> int:
+    with open(EVENT) as event_file:
+        event = json.load(event_file)
+    execution_id = event['detail']['queryExecutionId']
+    athena.dynamodb = StubDynamoDB({
+        'athena-queries': StubTable('query_id', [
+            {'query_id': 'q1', 'state': 'succeeded', 'execution_id': execution_id, 'context': {'tmptable': 'tmp.tmp1'}},
+            {'query_id': 'q2', 'state': 'running', 'execution_id': 'another-execution', 'context': {'tmptable': 'tmp.tmp2'}}
+        ])
+    })
+    compacted = StubTable('tmptable', [
+        transaction('tmp.tmp1', PARTITION),
+        transaction('tmp.tmp2', OTHER_PARTITION),
+        generations('tmp.tmp1', PARTITION),
+        generations('tmp.tmp2', OTHER_PARTITION)
+    ])
+    partitions_linker.dynamodb = compactions.dynamodb = manifests.dynamodb = StubDynamoDB({'compacted-partitions': compacted})
+    s3.s3 = StubS3({
+        ('data', f'firehose/events/{PARTITION}/f0'): ('{}', at(0)),
+        ('data', f'firehose/events/{PARTITION}/f1'): ('{}', at(5)),
+        ('data', f'firehose/events/{PARTITION}/late'): ('{}', at(10)),
+        ('data', f'firehose/events/compacted=1/tmp0/{PARTITION}/part-0'): ('parquet', at(1)),
+        ('data', f'firehose/events/compacted=2/tmp1/{PARTITION}/part-0'): ('parquet', at(8))
+    })
+    partitions_linker.glue = StubGlue()
+
+    replay(event)
+    state = compacted.get_item(Key={'tmptable': f's3://data/events/{PARTITION}/symlink.txt'})['Item']
+    other = compacted.get_item(Key={'tmptable': f's3://data/events/{OTHER_PARTITION}/symlink.txt'})['Item']
+    manifest = s3.s3.read(f's3://data/events/{PARTITION}/symlink.txt').split('\n')
+    puts = list(s3.s3.puts)
+    replay(event)
+
+    expected = [
+        f's3://data/firehose/events/compacted=1/tmp0/{PARTITION}',
+        f's3://data/firehose/events/compacted=2/tmp1/{PARTITION}',
+        f's3://data/firehose/events/{PARTITION}/late'
+    ]
+    print(f'deleted {partitions_linker.glue.deleted}, wrote {puts}')
+    print(f'manifest {manifest}')
+    checks = {
+        'the manifest lists the outputs then the later objects': manifest == expected,
+        'the manifest is written once': puts == [f'events/{PARTITION}/symlink.txt'] and s3.s3.puts == puts,
+        'the state records the new generation': state.get('outputs') == expected[:2] and state.get('cutoff') == at(5).isoformat() and state.get('linked') == 'tmp.tmp1',
+        'the lease is released': 'running' not in state and 'running_until' not in state,
+        'the running compaction is left alone': other.get('running') == 'tmp.tmp2' and 'linked' not in other,
+        'only the tmp table of the query is deleted': set(partitions_linker.glue.deleted) == {'tmp.tmp1'}
+    }
+    failed = [check for check, passed in checks.items() if not passed]
+    for check in failed:
+        print(f'failed: {check}')
+    if failed:
+        print(f'state {state}')
+        return 1
+    print('ok')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -15,7 +15,7 @@ from lib.decorators import kinesis_handler
 from lib.records import KinesisRecord
 from lib.glue import get_glue_table, glue
 
-# pylint: disable=invalid-name, line-too-long, unused-argument
+# pylint: disable=invalid-name, line-too-long, unused-argument, logging-fstring-interpolation
 
 patch_all()  # for xray tracing of boto libs
 firehose = boto3.client('firehose')
@@ -24,6 +24,8 @@ logs = boto3.client('logs')
 log = logging.getLogger()
 
 TMP_DATABASE = os.environ['TMP_DATABASE']
+# members of a table returned by GetTable accepted in the TableInput of UpdateTable
+TABLE_INPUT_KEYS = ('Name', 'Description', 'Owner', 'LastAccessTime', 'LastAnalyzedTime', 'Retention', 'StorageDescriptor', 'PartitionKeys', 'ViewOriginalText', 'ViewExpandedText', 'TableType', 'Parameters')
 
 json.JSONEncoder.default = lambda self, obj: (obj.isoformat() if isinstance(obj, type(datetime)) else str(obj))
 
@@ -31,18 +33,23 @@ json.JSONEncoder.default = lambda self, obj: (obj.isoformat() if isinstance(obj,
 @xray_recorder.capture()
 @kinesis_handler(event_types=[
     KinesisRecord.GLUE_SOURCE_EVENT
-])
+], batch_size=None)
 def handler(kinesis_records, context):
     """
     Listen to CloudTrail Glue events, and create a Kinesis Firehose for each new Glue table created
     """
-    detail = kinesis_records[0].parse().get('detail')
-    database_name = detail.get('databaseName')
-    if database_name != TMP_DATABASE:
-        return [
-            create_stream(create_config(database_name, table_name)) for table_name in detail.get('changedTables') 
-            if detail.get('typeOfChange') == 'CreateTable'
-        ] 
+    results: list = []
+    for kinesis_record in kinesis_records:
+        detail = kinesis_record.parse().get('detail')
+        database_name = detail.get('databaseName')
+        if database_name != TMP_DATABASE and detail.get('typeOfChange') == 'CreateTable':
+            results.extend([
+                create_stream(create_config(database_name, table_name)) for table_name in detail.get('changedTables')
+            ])
+            results.extend([
+                enable_projection(database_name, table_name) for table_name in detail.get('changedTables')
+            ])
+    return [result for result in results if result]
 
 @xray_recorder.capture()
 @backoff.on_exception(backoff.expo, botocore.exceptions.ClientError, max_time=10)
@@ -61,27 +68,7 @@ def create_config(database_name: str, table_name: dict):
 
     prefix = table.get_firehose_target()
     bucket_arn = f'arn:aws:s3:::{table.get_table_bucket()}'
-    partition_schema = params.get_partition_schema()
-
-    if not partition_schema:
-        # generate a partition schema based on the table
-        partition_schema_elements: list = []
-        for partition_key in [key.get('Name') for key in table.get_partition_keys()]:
-            if partition_key.lower() in ('year', 'yyyy'):
-                partition_schema_elements.append(f'{partition_key}=' + '!{timestamp:yyyy}')
-            elif partition_key.lower() in ('month', 'mm'):
-                partition_schema_elements.append(f'{partition_key}' + '=!{timestamp:MM}')
-            elif partition_key.lower() in ('day', 'dd'):
-                partition_schema_elements.append(f'{partition_key}' + '=!{timestamp:dd}')
-            elif partition_key.lower() in ('hour', 'hh'):
-                partition_schema_elements.append(f'{partition_key}' + '=!{timestamp:HH}')
-            elif partition_key.lower() in ('minute', 'min'):
-                partition_schema_elements.append(f'{partition_key}' + '=!{timestamp:mm}')
-            elif partition_key.lower() in ('date', 'day', 'dt'):
-                partition_schema_elements.append(f'{partition_key}' + '=!{timestamp:yyyyMMdd}')
-            elif partition_key.lower() in ('time', 'tm'):
-                partition_schema_elements.append(f'{partition_key}' + '=!{timestamp:HHmm}')
-        partition_schema = '/'.join(partition_schema_elements)
+    partition_schema = table.get_partition_schema()
 
     configuration = {
         'DatabaseName': database_name,
@@ -167,6 +154,33 @@ def create_config(database_name: str, table_name: dict):
         }
     return configuration
 
+@xray_recorder.capture()
+@backoff.on_exception(backoff.expo, botocore.exceptions.ClientError, max_time=10)
+def enable_projection(database_name: str, table_name: str):
+    """
+    Set the Athena partition projection parameters on the Glue Table if requested, so that its partitions
+    don't need to be registered in the catalog
+    """
+    table = get_glue_table(database_name, table_name)
+    if not table or not table.get_params().is_automation() or not table.get_params().is_partition_projection():
+        return None
+    projection = table.get_partition_projection()
+    if not projection:
+        log.warning({
+            'Code': 400,
+            'Message': f'partitions of {database_name}.{table_name} can\'t be projected, they will be registered'
+        })
+        return None
+    table_input = {
+        key: value for key, value in table.dump().items() if key in TABLE_INPUT_KEYS
+    }
+    table_input['Parameters'] = dict(table_input.get('Parameters', {}), **projection)
+    log.info(f'enabling partition projection on {database_name}.{table_name}: {projection}')
+    return glue.update_table(
+        DatabaseName=database_name,
+        TableInput=table_input
+    )
+
 @xray_recorder.capture()
 @backoff.on_exception(backoff.expo, botocore.exceptions.ClientError, max_time=10)
 def create_stream(config: dict) -> dict:
@@ -23,21 +23,23 @@ json.JSONEncoder.default = lambda self, obj: (obj.isoformat() if isinstance(obj,
 @xray_recorder.capture()
 @kinesis_handler(event_types=[
     KinesisRecord.FIREHOSE_SOURCE_EVENT
-])
+], batch_size=None)
 def handler(kinesis_records, context):
     """
     Listen to CloudTrail Firehose events, and create a log stream for the firehose if it doesn't exists
     """
-    detail = kinesis_records[0].parse().get('detail')
-    if detail:
-        log.info(detail)
-        try:
-            logging_options = detail['requestParameters']['extendedS3DestinationConfiguration']['cloudWatchLoggingOptions']
-            if logging_options.get('enabled'):
-                return create_logstream(logging_options)
-        except (KeyError, TypeError):
-            pass
-    return None
+    results: list = []
+    for kinesis_record in kinesis_records:
+        detail = kinesis_record.parse().get('detail')
+        if detail:
+            log.info(detail)
+            try:
+                logging_options = detail['requestParameters']['extendedS3DestinationConfiguration']['cloudWatchLoggingOptions']
+                if logging_options.get('enabled'):
+                    results.append(create_logstream(logging_options))
+            except (KeyError, TypeError):
+                pass
+    return results
 
 @xray_recorder.capture()
 @backoff.on_exception(backoff.expo, botocore.exceptions.ClientError, max_time=10)
@@ -4,20 +4,27 @@ Listen to the DynamoDB stream for partition events update Glue partitions metast
 import os
 import json
 import logging
+from collections import OrderedDict
 from datetime import datetime, timedelta
 from uuid import uuid4
 
 import backoff
 import boto3
+import aws_lambda_logging
 
 import botocore
 from aws_xray_sdk.core import patch_all, xray_recorder
 
 from lib.decorators import KinesisRecord, kinesis_handler
 from lib.glue import get_glue_table
-from lib.athena import execute_query
+from lib.athena import submit_query
+from lib.batches import Limits, pack
+from lib.compactions import get_generations, get_later_objects, get_cutoff
+from lib.compactions import schedule_compaction, cancel_compaction, get_due_compactions, claim_compaction, own_compaction, release_compaction
+from lib.manifests import MANIFEST_VERSION, refresh_objects
+from lib.s3 import list_objects, get_object_location
 
-# pylint: disable=invalid-name, line-too-long, unused-argument
+# pylint: disable=invalid-name, line-too-long, unused-argument, logging-fstring-interpolation
 
 patch_all()  # for xray tracing of boto libs
 dynamodb = boto3.resource('dynamodb')
@@ -26,52 +33,234 @@ DATA_BUCKET = os.environ['DATA_BUCKET']
 TMP_DATABASE = os.environ['TMP_DATABASE']
 COMPACTED_PARTITIONS = os.environ['COMPACTED_PARTITIONS']
 EPOCH = datetime.utcfromtimestamp(0)
+# athena query strings are limited to 256 KiB, the paths of the compacted objects take most of it
+QUERY_PATHS_BYTES = 200 * 1024
 
 json.JSONEncoder.default = lambda self, obj: (obj.isoformat() if isinstance(obj, type(datetime)) else str(obj))
 
+def handler(event, context):
+    """
+    Invoked with the events of the control stream, or on schedule to start the compactions due
+    """
+    if 'Records' in event:
+        return stream_handler(event, context)
+    return schedule_handler(event, context)
+
 @kinesis_handler(event_types=[
+    KinesisRecord.OPENED_PARTITION_EVENT,
     KinesisRecord.CLOSED_PARTITION_EVENT
-])
+], batch_size=None)
 @xray_recorder.capture()
-def handler(kinesis_records, context):
+def stream_handler(kinesis_records, context):
     """
-    Listen to Kinesis events and add a new partition to a table
+    Listen to Kinesis events and schedule the compaction of the closed partitions of simlinked tables at the end of their
+    table grace period, cancelling it if they reopen meanwhile. The compactions without grace period are started right away
     """
-    detail = kinesis_records[0].parse().get('detail')
-    record = detail.get('Record')
-    if record.get('leaf') and record.get('symlink'):
-        return compact_glue_partition(record)
+    now = datetime.utcnow()
+    grace_periods: dict = {}
+    due: list = []
+    for kinesis_record in kinesis_records:
+        record = kinesis_record.parse().get('detail').get('Record')
+        if not record.get('leaf') or not record.get('symlink'):
+            continue
+        if kinesis_record.is_any_of([KinesisRecord.OPENED_PARTITION_EVENT]):
+            if int(record.get('compacted', -1)) >= 0:
+                # late objects reopened a partition closed before, new partitions start at -1 and are closed once at 0
+                cancel_compaction(get_manifest_location(record))
+            continue
+        db_table = record['db_table']
+        if db_table not in grace_periods:
+            grace_periods[db_table] = get_grace_seconds(db_table)
+        item = schedule_compaction(get_manifest_location(record), record, (now + timedelta(seconds=grace_periods[db_table])).isoformat())
+        if not grace_periods[db_table]:
+            due.append(item)
+    return start_compactions(due, now)
 
+@xray_recorder.capture()
+def schedule_handler(event, context):
+    """
+    Start the compactions whose grace period ended, or that waited for the previous compaction of their partition
+    """
+    aws_lambda_logging.setup(
+        level=os.environ.get('LOGLEVEL', 'INFO'),
+        aws_request_id=context.aws_request_id,
+        boto_level='CRITICAL'
+    )
+    now = datetime.utcnow()
+    results = start_compactions(get_due_compactions(now.isoformat()), now)
+    if results:
+        log.info({
+            "Results" : results
+        })
+    return results
+
+def start_compactions(items: list, now: datetime) -> list:
+    """
+    Claim the compactions due and compact their partitions, the ones of a table closed in the same generation together
+    """
+    groups: dict = {}
+    for item in items:
+        record = claim_compaction(item, now)
+        if record:
+            # a CTAS writes a single location, so only the partitions of the same generation are compacted together
+            key = (record['db_table'], int(record.get('compacted', 0)))
+            groups.setdefault(key, OrderedDict())[record['partition']] = record
+    return [
+        compact_glue_partitions(db_table, compacted, list(records.values())) for (db_table, compacted), records in groups.items()
+    ]
+
+def get_grace_seconds(db_table: str) -> int:
+    """
+    Returns the seconds the compaction of a closed partition of the table waits for the partition to reopen
+    """
+    database_name, table_name = db_table.split('.', 1)
+    table = get_glue_table(database_name, table_name)
+    return table.get_params().get_compaction_grace_seconds() if table else 0
+
+def get_manifest_location(record: dict) -> str:
+    """
+    Returns the location of the symlink manifest of a partition
+    """
+    return f'{record["symlink"]}/{record["partition"]}/symlink.txt'
 
 @xray_recorder.capture()
-@backoff.on_exception(backoff.expo, botocore.exceptions.ClientError, max_time=10)
-def compact_glue_partition(record: dict):
+def compact_glue_partitions(db_table: str, compacted: int, records: list):
     """
-    Listen to Kinesis events and compact a partition for a simlinked table
+    Compact the partitions of a table worth compacting, in batches of up to 100 partitions per query.
+    Partitions compacted before only compact their later objects into a delta, until max deltas where they are rewritten
     """
-    db_table = record['db_table']
     database_name, table_name = db_table.split('.')
     table = get_glue_table(database_name, table_name)
     if not table:
+        for record in records:
+            release_compaction(get_manifest_location(record))
         return f"{db_table} not found"
-    symlink = record.get('symlink')
-    location = record['location']
-    partition = record['partition']
-    compacted = record.get('compacted',0)
-    target = location.replace(partition, '').rsplit('/', 2)[0] + f'/compacted={compacted}/' + partition
+    params = table.get_params()
+    max_deltas = params.get_compaction_max_deltas()
+    # bucket_count applies to every partition of a query, so partitions are batched with the ones of the same count
+    buckets: dict = {}
+    for record in records:
+        manifest = get_manifest_location(record)
+        listed = list_objects(record['location'])
+        generations = get_generations(manifest)
+        if generations.get('outputs') and MANIFEST_VERSION not in generations:
+            # the paths filtered below must be the ones the manifest lists
+            refresh_objects(manifest, record['location'])
+            generations = get_generations(manifest)
+        outputs = generations.get('outputs') or []
+        delta = bool(outputs) and len(outputs) <= max_deltas
+        later = get_later_objects(listed, generations)
+        paths = [get_object_location(record['location'], obj['Key']) for obj in later]
+        objects = later
+        if delta and not later:
+            # reopened without new objects, the manifest lists the compacted outputs only
+            refresh_objects(manifest, record['location'])
+            release_compaction(manifest)
+            continue
+        if not delta and outputs and not generations.get('listed'):
+            # the table reads the partition through its manifest, so a rewrite filters the files of the compacted outputs too
+            files = [(output, obj) for output in outputs for obj in list_objects(output)]
+            paths = [get_object_location(output, obj['Key']) for output, obj in files] + paths
+            objects = [obj for _, obj in files] + later
+        elif not delta:
+            # the manifest lists the whole firehose prefix
+            paths = [get_object_location(record['location'], obj['Key']) for obj in listed]
+            objects = listed
+        size = sum(obj['Size'] for obj in objects)
+        if len(objects) < params.get_compaction_min_objects() or size < params.get_compaction_min_bytes():
+            # compacting fewer or smaller files wouldn't make reading the partition any faster
+            log.info(f'skipping compaction of {record["location"]}, {len(objects)} objects of {size} bytes')
+            if delta:
+                # the manifest lists the later objects as they are, after the compacted outputs
+                refresh_objects(manifest, record['location'])
+            release_compaction(manifest)
+            continue
+        # the listed objects are all either compacted before or filtered in this query
+        cutoff, cutoff_keys = get_cutoff(listed)
+        buckets.setdefault(table.get_compaction_bucket_count(size), []).append(dict(record, compaction={
+            'manifest': manifest,
+            'paths': paths,
+            'outputs': outputs if delta else [],
+            'cutoff': cutoff,
+            'cutoff_keys': cutoff_keys,
+            'previous_cutoff': generations.get('cutoff')
+        }))
+    max_partitions = params.get_compaction_max_partitions()
+    return [
+        compact_glue_partition(table, db_table, compacted, bucket_count, batch)
+        for bucket_count, bucket_records in buckets.items()
+        for batch in pack_paths(bucket_records, max_partitions)
+    ]
+
+def pack_paths(records: list, max_partitions: int):
+    """
+    Packs the records of a query so that the paths of their objects fit the query string. The objects
+    of an oversized partition are not filtered, rewriting all of them with the outputs compacted before
+    """
+    limits = Limits(count=max_partitions, size=QUERY_PATHS_BYTES, record_size=QUERY_PATHS_BYTES)
+    oversized: list = []
+    yield from pack(records, limits, sizeof=get_paths_size, oversized=oversized)
+    for record in oversized:
+        log.warning(f'too many objects to filter in {record["location"]}, the partition is rewritten')
+        record['compaction'].update(paths=[], outputs=[])
+    yield from pack(oversized, limits, sizeof=get_paths_size)
+
+def get_paths_size(record: dict) -> int:
+    """
+    Returns the length of the path filter of a record in the query string
+    """
+    return sum(len(path) + 4 for path in record['compaction']['paths'])
+
+@xray_recorder.capture()
+@backoff.on_exception(backoff.expo, botocore.exceptions.ClientError, max_time=10)
+def compact_glue_partition(table, db_table: str, compacted: int, bucket_count: int, records: list):
+    """
+    Compact partitions of a simlinked table in a single partitioned CTAS, writing bucket_count files per partition
+    unless the table sets its bucket count. Each partition is filtered on the paths of its objects to compact, if any
+    """
+    if not records:
+        return None
+    tmp_name = f'tmp{str(uuid4()).replace("-","")}'
+    tmp_table = f'{TMP_DATABASE}.{tmp_name}'
+    # a CTAS location must be empty, each query writes under its own prefix
+    location = records[0]['location']
+    target = location.replace(records[0]['partition'], '').rsplit('/', 2)[0] + f'/compacted={compacted}/{tmp_name}'
     storage = table.get_storage_descriptor()
+    partition_keys = [key['Name'] for key in table.get_partition_keys()]
     columns = ', '.join([
         f'\"{column["Name"]}\"' for column in storage.get('Columns', [])
+    ] + [
+        f'\"{key}\"' for key in partition_keys
     ])
-    values = record['values']
-    clause = ' AND '.join([
-        f"\"{key['Name']}\"='{values[idx]}'" for idx, key in enumerate(table.get_partition_keys())
-    ])
-    tmp_table = f'{TMP_DATABASE}.tmp{str(uuid4()).replace("-","")}'
+    clauses: list = []
+    partitions: list = []
+    for record in records:
+        values = record['values']
+        compaction = record['compaction']
+        conditions = [
+            f"\"{key}\"='{values[idx]}'" for idx, key in enumerate(partition_keys)
+        ]
+        if compaction['paths']:
+            # only the objects listed, the later ones are left to the next generation
+            conditions.append('\"$path\" IN (' + ', '.join(f"'{path}'" for path in compaction['paths']) + ')')
+        clauses.append('(' + ' AND '.join(conditions) + ')')
+        partitions.append({
+            # athena writes each partition in hive style under the query location
+            'target': target + ''.join(f'/{key}={values[idx]}' for idx, key in enumerate(partition_keys)),
+            'location': compaction['manifest'],
+            'source': record['location'],
+            'outputs': compaction['outputs'],
+            'cutoff': compaction['cutoff'],
+            'cutoff_keys': compaction['cutoff_keys'],
+            'previous_cutoff': compaction['previous_cutoff'],
+            # the record of the pending compaction, scheduled again if the query fails
+            'pending': json.dumps({key: value for key, value in record.items() if key != 'compaction'})
+        })
     with_parts = [
         f"external_location = '{target}'",
         "format = 'Parquet'",
-        table.get_compaction_bucketing(),
+        'partitioned_by = ARRAY[' + ','.join([f"'{key}'" for key in partition_keys]) + ']',
+        table.get_compaction_bucketing(bucket_count),
     ]
     sorting = table.get_compaction_sorting()
     if sorting:
@@ -81,23 +270,30 @@ def compact_glue_partition(record: dict):
         WITH ({', '.join(with_parts)}) 
         AS SELECT {columns}
         FROM {db_table} 
-        WHERE {clause}
+        WHERE {' OR '.join(clauses)}
         {table.get_compaction_sorting()}
     """
     query = ' '.join(query.replace('\n', ' ').split())
-    response = log_transaction(tmp_table, target, f'{symlink}/{partition}/symlink.txt', query)
+    for partition in partitions:
+        # only this query may release the lease of its partitions, once linked
+        own_compaction(partition['location'], tmp_table)
+    response = log_transaction(tmp_table, partitions, query)
     if response:
-        return execute_query(query, DATA_BUCKET)
+        # started by the queries manager, once athena has capacity for it
+        return submit_query(query, DATA_BUCKET, {'tmptable': tmp_table})
+    return None
 
 
 @xray_recorder.capture()
 @backoff.on_exception(backoff.expo, botocore.exceptions.ClientError, max_time=10)
-def log_transaction(tmptable, target, location, query):
+def log_transaction(tmptable, partitions, query):
+    """
+    Log the (target, symlink location, generations) of the partitions compacted by the query writing tmptable
+    """
     return dynamodb.Table(COMPACTED_PARTITIONS).put_item(
         Item={
             'tmptable': tmptable,
-            'target': target,
-            'location': location,
+            'partitions': partitions,
             'query': query,
             'expiry': int((datetime.now() + timedelta(days=1) - EPOCH).total_seconds())
         }
@@ -1,5 +1,5 @@
 """"
-Listen to CloudTrail Glue events in the tmp database, and create a symlink to the compacted partition
+Listen to Athena query completions, or CloudTrail Glue events in the tmp database, and create a symlink to the compacted partition
 """
 import json
 import logging
@@ -13,6 +13,9 @@ from aws_xray_sdk.core import patch_all, xray_recorder
 
 from lib.decorators import kinesis_handler, KinesisRecord
 from lib.glue import glue
+from lib.athena import get_query
+from lib.compactions import release_compaction
+from lib.manifests import swap_generations
 from lib.s3 import upload_file, check_prefix
 
 # pylint: disable=invalid-name, line-too-long, unused-argument, logging-fstring-interpolation
@@ -29,18 +32,35 @@ json.JSONEncoder.default = lambda self, obj: (obj.isoformat() if isinstance(obj,
 
 @xray_recorder.capture()
 @kinesis_handler(event_types=[
-    KinesisRecord.GLUE_SOURCE_EVENT
-])
+    KinesisRecord.GLUE_SOURCE_EVENT,
+    KinesisRecord.ATHENA_SOURCE_EVENT
+], batch_size=None)
 def handler(kinesis_records, context):
     """
-    Listen to CloudTrail Glue events in the tmp database, and create a symlink to the compacted partition
+    Listen to Athena query completions, or CloudTrail Glue events in the tmp database, and create a symlink to the compacted partition.
+    The Athena event arrives as soon as the compaction query ends, the CloudTrail one minutes later, linking is idempotent
     """
-    detail = kinesis_records[0].parse().get('detail')
-    if detail.get('typeOfChange') == 'CreateTable':
-        tables = detail.get('changedTables')
-        database_name = detail.get('databaseName')
-        if database_name == TMP_DATABASE:
-            return [update_simlink(database_name, table_name) for table_name in tables]
+    results: list = []
+    for kinesis_record in kinesis_records:
+        detail = kinesis_record.parse().get('detail')
+        if kinesis_record.is_any_of([KinesisRecord.ATHENA_SOURCE_EVENT]):
+            if detail.get('currentState') == 'SUCCEEDED':
+                results.append(link_query(detail.get('queryExecutionId')))
+        elif detail.get('typeOfChange') == 'CreateTable' and detail.get('databaseName') == TMP_DATABASE:
+            results.extend([update_simlink(TMP_DATABASE, table_name) for table_name in detail.get('changedTables')])
+    return results
+
+@xray_recorder.capture()
+def link_query(execution_id: str):
+    """
+    Link the partitions compacted by a succeeded query, if it was a compaction submitted through the queries manager
+    """
+    query = get_query(execution_id)
+    tmptable = query and query.get('context', {}).get('tmptable')
+    if not tmptable:
+        return None
+    database_name, table_name = tmptable.split('.', 1)
+    return update_simlink(database_name, table_name)
 
 @xray_recorder.capture()
 @backoff.on_exception(backoff.expo, botocore.exceptions.ClientError, max_time=10)
@@ -59,11 +79,39 @@ def update_simlink(database_name: str, table_name: dict):
         }
     ).get('Item')
     if item:
-        # make sure target exists
-        if check_prefix(item.get('target')):
-            log.info(f"updating {item.get('location')} with {item.get('target')}")
-            return upload_file(
-                item.get('location'),
-                item.get('target')        
-            )
+        # transactions compact a list of partitions, or a single one in older items
+        partitions = item.get('partitions') or [{'target': item.get('target'), 'location': item.get('location')}]
+        return [
+            link_generation(partition, f'{database_name}.{table_name}') if 'cutoff' in partition else link_partition(partition['target'], partition['location'])
+            for partition in partitions
+        ]
+    return None
+
+def link_generation(partition: dict, tmptable: str):
+    """
+    Swap the symlink manifest of a partition to its compacted outputs, the ones of the previous generations
+    followed by the new one, then the objects not compacted yet, and record them for the next delta.
+    Linking the same tmptable again, from the Athena and CloudTrail events, is skipped
+    """
+    outputs = list(partition.get('outputs') or [])
+    if check_prefix(partition['target']):
+        outputs.append(partition['target'])
+    if not outputs:
+        release_compaction(partition['location'], tmptable)
+        return None
+    return swap_generations(
+        partition['location'], tmptable, partition.get('source'), outputs, partition['cutoff'], partition.get('cutoff_keys') or [], partition.get('previous_cutoff')
+    )
+
+def link_partition(target: str, location: str):
+    """
+    Point the symlink of a partition to its compacted files
+    """
+    # make sure target exists
+    if check_prefix(target):
+        log.info(f"updating {location} with {target}")
+        return upload_file(
+            location,
+            target
+        )
     return None
@@ -6,87 +6,94 @@ import json
 import logging
 import os
 import re
-from datetime import datetime
+from collections import OrderedDict
+from datetime import datetime, timedelta
 
 import boto3
-from boto3.dynamodb.conditions import  Key, Attr
+from boto3.dynamodb.conditions import Key
 import backoff
 import botocore
 from aws_xray_sdk.core import patch_all, xray_recorder
-from cachetools import cached, TTLCache
+from cachetools import TTLCache
 
 from lib.decorators import KinesisRecord, kinesis_handler
+from lib.locations import LocationsIndex
+from lib.manifests import append_objects
+from lib.partitions import OPENED, CLOSED, OPEN_INDEX, OPEN_LOCATOR, query_all, transition as transition_partition, touch, get_last_activity
 
-# pylint: disable=invalid-name, line-too-long, unused-argument
+# pylint: disable=invalid-name, line-too-long, unused-argument, logging-fstring-interpolation
 
 patch_all()  # for xray tracing of boto libs
 dynamodb = boto3.resource('dynamodb')
 log = logging.getLogger()
-dynamo_table_cache = TTLCache(maxsize=1000, ttl=3600)
 
 json.JSONEncoder.default = lambda self, obj: (obj.isoformat() if isinstance(obj, type(datetime)) else str(obj))
 S3_ARN_TO_PARTS = re.compile(r'arn:aws:s3:([^:]*):(\d*):([^/]+)/(.*)')
-OPENED = "opened"
-CLOSED = "closed"
 GLUE_TABLES_LOCATOR = os.environ['GLUE_TABLES_LOCATOR']
 GLUE_PARTITIONS_MAPPER = os.environ['GLUE_PARTITIONS_MAPPER']
+locations = LocationsIndex(dynamodb.Table(GLUE_TABLES_LOCATOR))
+# the partition known to be open at each locator, kept across warm invocations so that objects landing in an
+# already open partition need no dynamodb read, only a touch of the leaf that fails if it was closed meanwhile
+OPEN_PARTITIONS_TTL = int(os.environ.get('OPEN_PARTITIONS_TTL', '60'))
+open_partitions = TTLCache(maxsize=10000, ttl=OPEN_PARTITIONS_TTL)
+# locators whose open partitions written before the open index have been added to it by this container
+indexed_locators: set = set()
 
 @xray_recorder.capture()
 @kinesis_handler(event_types=[
     KinesisRecord.S3_SOURCE_EVENT
-])
+], batch_size=None)
 def handler(kinesis_records, context):
     """
     Listen to CloudTrail S3 events, and updates the partition map for the corresponding Glue table in DynamoDB
+    Objects of the batch are coalesced by prefix, so that each partition is processed once, and its manifest written once
     """
-    detail = kinesis_records[0].parse().get('detail')
+    prefixes: OrderedDict = OrderedDict()
+    for kinesis_record in kinesis_records:
+        for bucket, key in get_objects(kinesis_record.parse().get('detail')):
+            prefix = key.rsplit('/', 1)[0]
+            # keep the order of the latest object in each prefix, so the last written partition is the one left open
+            keys = prefixes.pop((bucket, prefix), [])
+            keys.append(key)
+            prefixes[(bucket, prefix)] = keys
+    log.info(f'{len(prefixes)} partition prefixes in {len(kinesis_records)} events')
+    # partition levels shared by several prefixes, like the day of many hours, are only checked once per batch
+    processed: set = set()
+    results: list = []
+    for (bucket, prefix), keys in prefixes.items():
+        item = get_table(bucket, prefix)
+        results.append(append_partition(item, bucket, prefix, processed))
+        if item and item.get('symlink'):
+            results.append(append_manifest(item, bucket, prefix, keys))
+    return results
+
+def get_objects(detail: dict) -> list:
+    """
+    Returns the (bucket, key) of every S3 object in the event
+    """
+    objects: list = []
     for resource in detail.get('resources', []):
         if resource.get('type') == 'AWS::S3::Object':
             match = S3_ARN_TO_PARTS.match(resource.get('ARN'))
             log.info(resource.get('ARN'))
             if match:
-                bucket = match[3]
-                prefix = match[4].rsplit('/', 1)[0]
-                return append_partition(get_table(bucket, prefix), bucket, prefix)
-    return None
+                objects.append((match[3], match[4]))
+    return objects
 
 @xray_recorder.capture()
-@cached(dynamo_table_cache)
-@backoff.on_exception(backoff.expo, botocore.exceptions.ClientError, max_time=10)
 def get_table(bucket: str, prefix: str):
     """
-    Find Glue Table based on location
+    Find Glue Table based on location, from the in memory index of the table locations
     """
-    dynamo = dynamodb.Table(GLUE_TABLES_LOCATOR)
-    while prefix:
-        location = f"s3://{bucket}/{prefix}"
-        item = dynamo.get_item(
-            Key={
-                'location': location
-            }
-        ).get('Item')
-        if item:
-            symlink = item.get('symlink')
-            if symlink:
-                symlinked = dynamo.get_item(
-                    Key={
-                        'location': symlink
-                    }
-                ).get('Item')
-                # merge the two records
-                if symlinked:
-                    symlinked.update(item)
-                    return symlinked
-            return item
-        if not '/' in prefix:
-            return
-        prefix = prefix.rsplit('/', 1)[0]
+    return locations.lookup(bucket, prefix)
 
 @xray_recorder.capture()
 @backoff.on_exception(backoff.expo, botocore.exceptions.ClientError, max_time=10)
-def append_partition(item: dict, bucket: str, prefix: str):
+def append_partition(item: dict, bucket: str, prefix: str, processed: set = None, cached: bool = True):
     """
     Append the new partition to dynamodb table of partitions
+    Partition levels in processed are skipped, and the ones checked are added to it once they are all written.
+    Levels cached open are skipped too, unless the leaf turns out closed, in which case the path is read again uncached
     """
     log.info(item)
     if not item:
@@ -95,14 +102,14 @@ def append_partition(item: dict, bucket: str, prefix: str):
     if not partition_keys:
         return f"Table at {bucket}/{prefix} is not partitioned"
 
-    dynamo = dynamodb.Table(os.environ['GLUE_PARTITIONS_MAPPER'])
     location = item['location']
     partition = prefix.replace(location.split('/', 3)[3], "")[1:]
     symlink = item.get('symlink')
     partition_segments = partition.split('/')
     db_table = f'{item["database_name"]}.{item["table_name"]}'
 
-    batch_items: list = []
+    levels: list = []
+    hits: list = []
     values: list = []
     timestamp = datetime.utcnow().isoformat()
     for idx, partition_key in enumerate(partition_keys):
@@ -114,49 +121,227 @@ def append_partition(item: dict, bucket: str, prefix: str):
         values.append(segment.split('=')[-1])
         locator = f'{location}:{idx:02}:{partition_key["Name"]}'
         partition = '/'.join([partition_segments[i] for i in range(0, idx+1)])
-        partition_entry = dynamo.get_item(
-            Key={
-                'locator': locator,
-                'partition': partition
-            }
-        ).get('Item')
-        if partition_entry:
-            if partition_entry['state'] == CLOSED:
-                partition_entry['state'] = OPENED
-                partition_entry['updated'] = timestamp
-                log.info(f'object added to closed partition at {partition_entry["location"]}, reopening')
-                batch_items.append(partition_entry)
-        else:
-            partition_entry = {
-                'locator': locator,
-                'partition': partition,
-                'location': f's3://{bucket}/{prefix}',
-                'db_table': db_table,
-                'state': OPENED,
-                'values': values,
-                'leaf': idx == len(partition_keys) - 1,
-                'compacted': -1,
-                'created': timestamp,
-                'updated': timestamp
-            }
-            if symlink:
-                partition_entry['symlink'] = symlink
-            log.info(f'object added to new partition at {partition_entry["location"]}')
-            batch_items.append(partition_entry)
+        if processed is not None and (locator, partition) in processed:
+            continue
+        partition_entry = {
+            'locator': locator,
+            'partition': partition,
+            'location': f's3://{bucket}/{prefix}',
+            'db_table': db_table,
+            'state': OPENED,
+            'values': values,
+            'leaf': idx == len(partition_keys) - 1,
+            OPEN_LOCATOR: locator,
+            'compacted': -1,
+            'created': timestamp,
+            'updated': timestamp,
+            'touched': timestamp
+        }
+        if symlink:
+            partition_entry['symlink'] = symlink
+        if cached and open_partitions.get(locator) == partition:
+            hits.append(partition_entry)
+            continue
+        levels.append(partition_entry)
+    if hits and hits[-1]['leaf'] and not touch_partition(hits[-1], timestamp):
+        # closed by a sibling or the sweeper since it was cached
+        for hit in hits:
+            open_partitions.pop(hit['locator'], None)
+        return append_partition(item, bucket, prefix, processed, cached=False)
+    if not levels:
+        return None
+
+    # all the levels of the path are read at once
+    partition_entries = get_partitions([
+        {'locator': level['locator'], 'partition': level['partition']} for level in levels
+    ])
+    changes: list = []
+    for level in levels:
+        locator = level['locator']
+        partition = level['partition']
+        partition_entry = partition_entries.get((locator, partition))
+        if not partition_entry:
+            log.info(f'object added to new partition at {level["location"]}')
+            partition_entry = create_partition(level)
+            if partition_entry is level:
+                changes.append(partition_entry)
+        if partition_entry and partition_entry['state'] == CLOSED:
+            log.info(f'object added to closed partition at {partition_entry["location"]}, reopening')
+            partition_entry = reopen_partition(partition_entry, timestamp)
+            changes.append(partition_entry)
+        elif partition_entry and partition_entry is not level and is_idle(partition_entry, OPEN_PARTITIONS_TTL):
+            # objects landing in an open partition are recorded for the sweeper, at most once per cache period
+            if not touch_partition(partition_entry, timestamp):
+                log.info(f'object added to partition at {partition_entry["location"]} closed meanwhile, reopening')
+                partition_entry = reopen_partition(partition_entry, timestamp)
+                changes.append(partition_entry)
         # find and close all other sibling partitions that are still open
-        open_partitions = dynamo.query(
+        for open_sibling in get_open_siblings(locator, partition):
+            log.info(f'closing partition at {open_sibling["locator"]}, {open_sibling["partition"]}')
+            changes.append(close_partition(open_sibling, timestamp))
+        if partition_entry and partition_entry['state'] == OPENED:
+            open_partitions[locator] = partition
+    if processed is not None:
+        # only once all the levels were written, so that a retry of the whole path processes them again
+        processed.update((level['locator'], level['partition']) for level in levels)
+    changes = [change for change in changes if change]
+    return changes or None
+
+@xray_recorder.capture()
+def append_manifest(item: dict, bucket: str, prefix: str, keys: list):
+    """
+    Add the objects landed in a leaf partition of a simlinked table to the symlink manifest of the partition
+    """
+    partition_keys = item.get('partition_keys')
+    partition = prefix.replace(item['location'].split('/', 3)[3], "")[1:]
+    if not partition_keys or len(partition.split('/')) != len(partition_keys):
+        return None
+    return append_objects(
+        f'{item["symlink"]}/{partition}/symlink.txt',
+        f's3://{bucket}/{prefix}',
+        [f's3://{bucket}/{key}' for key in keys]
+    )
+
+@xray_recorder.capture()
+def get_partitions(keys: list) -> dict:
+    """
+    Read the partition entries with the given keys in a single BatchGetItem, retrying unprocessed keys.
+    Returns them by (locator, partition)
+    """
+    entries: dict = {}
+    request = {
+        GLUE_PARTITIONS_MAPPER: {
+            'Keys': keys,
+            'ConsistentRead': True
+        }
+    }
+    while request:
+        response = dynamodb.batch_get_item(RequestItems=request)
+        for entry in response.get('Responses', {}).get(GLUE_PARTITIONS_MAPPER, []):
+            entries[(entry['locator'], entry['partition'])] = entry
+        request = response.get('UnprocessedKeys')
+    return entries
+
+@xray_recorder.capture()
+def get_open_siblings(locator: str, partition: str) -> list:
+    """
+    Returns the open partitions of the locator other than the given one, from the sparse open index.
+    The partition is excluded by the key conditions rather than a filter, so that only open siblings are read
+    """
+    if locator not in indexed_locators:
+        index_open_partitions(locator)
+    dynamo = dynamodb.Table(GLUE_PARTITIONS_MAPPER)
+    return query_all(
+        dynamo,
+        IndexName=OPEN_INDEX,
+        KeyConditionExpression=Key(OPEN_LOCATOR).eq(locator) & Key('partition').lt(partition)
+    ) + query_all(
+        dynamo,
+        IndexName=OPEN_INDEX,
+        KeyConditionExpression=Key(OPEN_LOCATOR).eq(locator) & Key('partition').gt(partition)
+    )
+
+def index_open_partitions(locator: str):
+    """
+    Adds the open partitions of the locator written before the open index to it, once per container.
+    Only opened entries are read from the state index, and those already indexed are left untouched
+    """
+    for entry in query_all(
+            dynamodb.Table(GLUE_PARTITIONS_MAPPER),
             IndexName='state-index',
-            KeyConditionExpression=Key('locator').eq(locator) & Key('state').eq(OPENED),
-            FilterExpression=Attr('partition').ne(partition)
-        ).get('Items')
-        for open_partition in open_partitions:
-            open_partition['state'] = CLOSED
-            open_partition['compacted'] = open_partition.get('compacted', -1) + 1
-            open_partition['updated'] = timestamp
-            log.info(f'closing partition at {open_partition["locator"]}, {open_partition["partition"]}')
-            batch_items.append(open_partition)
-    if batch_items:
-        with dynamo.batch_writer(overwrite_by_pkeys=['locator', 'partition']) as batch:
-            for batch_item in batch_items:
-                batch.put_item(Item=batch_item)
-        return batch_items
+            KeyConditionExpression=Key('locator').eq(locator) & Key('state').eq(OPENED)
+    ):
+        if OPEN_LOCATOR not in entry:
+            try:
+                dynamodb.Table(GLUE_PARTITIONS_MAPPER).update_item(
+                    Key={
+                        'locator': entry['locator'],
+                        'partition': entry['partition']
+                    },
+                    UpdateExpression='SET #open_locator = :locator',
+                    ConditionExpression='#state = :opened',
+                    ExpressionAttributeNames={'#open_locator': OPEN_LOCATOR, '#state': 'state'},
+                    ExpressionAttributeValues={':locator': entry['locator'], ':opened': OPENED}
+                )
+            except dynamodb.meta.client.exceptions.ConditionalCheckFailedException:
+                pass
+    indexed_locators.add(locator)
+
+def is_idle(partition_entry: dict, seconds: int) -> bool:
+    """
+    Returns True if no transition nor object was recorded in the partition for the given seconds
+    """
+    return get_last_activity(partition_entry) < (datetime.utcnow() - timedelta(seconds=seconds)).isoformat()
+
+@xray_recorder.capture()
+def create_partition(partition_entry: dict):
+    """
+    Put a new partition entry, unless another writer created it first, in which case its current entry is returned
+    """
+    partition_entry['version'] = 1
+    try:
+        dynamodb.Table(GLUE_PARTITIONS_MAPPER).put_item(
+            Item=partition_entry,
+            ConditionExpression='attribute_not_exists(#locator)',
+            ExpressionAttributeNames={'#locator': 'locator'}
+        )
+        return partition_entry
+    except dynamodb.meta.client.exceptions.ConditionalCheckFailedException:
+        open_partitions.pop(partition_entry['locator'], None)
+        return dynamodb.Table(GLUE_PARTITIONS_MAPPER).get_item(
+            Key={
+                'locator': partition_entry['locator'],
+                'partition': partition_entry['partition']
+            },
+            ConsistentRead=True
+        ).get('Item')
+
+@xray_recorder.capture()
+def reopen_partition(partition_entry: dict, timestamp: str, attempts: int = 3):
+    """
+    Transition a closed partition to opened, if it is still at the version read.
+    On conflict the entry is read again, and reopened only if it is still closed.
+    Returns the reopened entry, or None if it wasn't reopened here
+    """
+    for _ in range(attempts):
+        updated = transition(partition_entry, CLOSED, OPENED, timestamp)
+        if updated:
+            return updated
+        partition_entry = dynamodb.Table(GLUE_PARTITIONS_MAPPER).get_item(
+            Key={
+                'locator': partition_entry['locator'],
+                'partition': partition_entry['partition']
+            },
+            ConsistentRead=True
+        ).get('Item')
+        if not partition_entry or partition_entry['state'] != CLOSED:
+            break
+    return None
+
+@xray_recorder.capture()
+def close_partition(partition_entry: dict, timestamp: str):
+    """
+    Transition an opened partition to closed, incrementing its compaction generation,
+    if it is still at the version read. On conflict another writer got there first, and nothing is done
+    """
+    return transition(partition_entry, OPENED, CLOSED, timestamp, compact=True)
+
+def touch_partition(partition_entry: dict, timestamp: str) -> bool:
+    """
+    Record that an object landed in an open partition. Returns False if the partition isn't open anymore,
+    dropping the cached open partition of its locator
+    """
+    if touch(dynamodb.Table(GLUE_PARTITIONS_MAPPER), partition_entry, timestamp):
+        return True
+    open_partitions.pop(partition_entry['locator'], None)
+    return False
+
+def transition(partition_entry: dict, from_state: str, to_state: str, timestamp: str, compact: bool = False):
+    """
+    Conditionally update the state of a partition entry, a conflict drops the cached open partition of its locator.
+    Returns the updated entry, or None on conflict
+    """
+    updated = transition_partition(dynamodb.Table(GLUE_PARTITIONS_MAPPER), partition_entry, from_state, to_state, timestamp, compact)
+    if not updated:
+        open_partitions.pop(partition_entry['locator'], None)
+    return updated
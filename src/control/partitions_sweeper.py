@@ -0,0 +1,85 @@
+"""
+Scheduled sweep closing the partitions that received no object for longer than their table idle threshold
+"""
+import os
+import logging
+import time
+from datetime import datetime, timedelta
+
+import boto3
+import botocore
+import aws_lambda_logging
+from aws_xray_sdk.core import patch_all, xray_recorder
+
+from lib.batches import get_deadline
+from lib.glue import get_glue_table
+from lib.partitions import OPENED, CLOSED, OPEN_INDEX, scan_all, transition, get_last_activity
+
+# pylint: disable=invalid-name, line-too-long, unused-argument, logging-fstring-interpolation
+
+patch_all()  # for xray tracing of boto libs
+dynamodb = boto3.resource('dynamodb')
+log = logging.getLogger()
+GLUE_PARTITIONS_MAPPER = os.environ['GLUE_PARTITIONS_MAPPER']
+# the mapper records objects landing in an open partition at most once per cache period, and a container
+# may keep a partition cached as open for another period, so shorter thresholds would close active partitions
+OPEN_PARTITIONS_TTL = int(os.environ.get('OPEN_PARTITIONS_TTL', '60'))
+
+@xray_recorder.capture()
+def handler(event, context):
+    """
+    Close the idle open partitions, the closed events then follow the DynamoDB stream to the compactor
+    """
+    aws_lambda_logging.setup(
+        level=os.environ.get('LOGLEVEL', 'INFO'),
+        aws_request_id=context.aws_request_id,
+        boto_level='CRITICAL'
+    )
+    deadline = get_deadline(context)
+    dynamo = dynamodb.Table(GLUE_PARTITIONS_MAPPER)
+    now = datetime.utcnow()
+    timestamp = now.isoformat()
+    # the index is sparse, the scan reads the open partitions only
+    open_entries = scan_all(dynamo, IndexName=OPEN_INDEX)
+    log.info(f'{len(open_entries)} open partitions')
+
+    closed: list = []
+    thresholds: dict = {}
+    for partition_entry in open_entries:
+        if time.monotonic() > deadline:
+            log.info('sweep deadline reached, the remaining partitions are left to the next sweep')
+            break
+        if not partition_entry.get('leaf'):
+            # only leaf partitions are compacted, parent levels are left to the sibling closing of the mapper
+            continue
+        db_table = partition_entry['db_table']
+        if db_table not in thresholds:
+            thresholds[db_table] = get_idle_seconds(db_table)
+        idle_seconds = thresholds[db_table]
+        if not idle_seconds:
+            continue
+        idle_since = (now - timedelta(seconds=idle_seconds)).isoformat()
+        if get_last_activity(partition_entry) >= idle_since:
+            continue
+        log.info(f'closing idle partition at {partition_entry["locator"]}, {partition_entry["partition"]}')
+        # same conditional close as the mapper, unless an object was recorded since the scan
+        updated = transition(dynamo, partition_entry, OPENED, CLOSED, timestamp, compact=True, idle_since=idle_since)
+        if updated:
+            closed.append(updated)
+    log.info(f'{len(closed)} idle partitions closed')
+    return closed
+
+def get_idle_seconds(db_table: str) -> int:
+    """
+    Returns the idle seconds after which the partitions of the table are closed, 0 if they are not swept
+    """
+    database_name, table_name = db_table.split('.', 1)
+    try:
+        table = get_glue_table(database_name, table_name)
+    except botocore.exceptions.ClientError as ex:
+        log.error(ex)
+        return 0
+    if not table:
+        return 0
+    idle_seconds = table.get_params().get_partition_idle_seconds()
+    return max(idle_seconds, 2 * OPEN_PARTITIONS_TTL) if idle_seconds > 0 else 0
@@ -9,9 +9,10 @@ from datetime import datetime
 import backoff
 import botocore
 from aws_xray_sdk.core import patch_all, xray_recorder
+from lib.batches import get_deadline, retry_failed
 from lib.decorators import KinesisRecord, kinesis_handler
 from lib.glue import get_glue_table, glue
-from lib.s3 import upload_file
+from lib.manifests import publish_manifest
 
 # pylint: disable=invalid-name, line-too-long, unused-argument
 
@@ -19,65 +20,200 @@ patch_all()  # for xray tracing of boto libs
 
 log = logging.getLogger()
 DATA_BUCKET = os.environ['DATA_BUCKET']
+# BatchCreatePartition accepts 100 partitions, BatchGetPartition 1000
+CREATE_BATCH_SIZE = 100
+GET_BATCH_SIZE = 1000
+# per partition errors worth another attempt, the others are final
+TRANSIENT_ERRORS = ('InternalServiceException', 'OperationTimeoutException', 'ThrottlingException', 'ConcurrentModificationException')
 
 json.JSONEncoder.default = lambda self, obj: (obj.isoformat() if isinstance(obj, type(datetime)) else str(obj))
 
 @kinesis_handler(event_types=[
     KinesisRecord.OPENED_PARTITION_EVENT
-])
+], batch_size=None)
 @xray_recorder.capture()
 def handler(kinesis_records, context):
     """
-    Listen to Kinesis events and add a new partition to a table
+    Listen to Kinesis events and add the new partitions to their tables,
+    the partitions of a table are registered together for the whole batch
     """
-    detail = kinesis_records[0].parse().get('detail')
-    record = detail.get('Record')
-    if record.get('leaf'):
-        return add_glue_partition(record)
+    results: list = []
+    tables: dict = {}
+    for kinesis_record in kinesis_records:
+        record = kinesis_record.parse().get('detail').get('Record')
+        if not record.get('leaf'):
+            continue
+        if record.get('symlink'):
+            results.append(add_symlink(record))
+        else:
+            # the latest event of a partition wins
+            tables.setdefault(record['db_table'], {})[tuple(record['values'])] = record
+    deadline = get_deadline(context)
+    for db_table, records in tables.items():
+        results.append(add_glue_partitions(db_table, list(records.values()), deadline))
+    return results
 
 @xray_recorder.capture()
-@backoff.on_exception(backoff.expo, botocore.exceptions.ClientError, max_time=10)
-def add_glue_partition(record: dict):
-    """
-    Add the partition to Glue
-    """
-    location = record['location']
-    symlink = record.get('symlink')
-    if symlink:
-        # event is for a firehose location, just create a symlink
-        partition = record['partition']
-        return upload_file(
-            f'{symlink}/{partition}/symlink.txt',
-            f'{location}/'
-        )
-    # event is for a glue location add the current partition
-    db_table = record['db_table']
-    database_name, table_name = db_table.split('.')
+def add_symlink(record: dict):
+    """
+    Event is for a firehose location, write the manifest of the partition listing its compacted outputs and objects
+    """
+    return publish_manifest(
+        f'{record["symlink"]}/{record["partition"]}/symlink.txt',
+        record['location']
+    )
 
-    values = record['values']
+@xray_recorder.capture()
+def add_glue_partitions(db_table: str, records: list, deadline: float):
+    """
+    Add the partitions to a Glue table, in batches of 100. Partitions already registered
+    are updated if their storage descriptor changed
+    """
+    database_name, table_name = db_table.split('.')
     table = get_glue_table(database_name, table_name)
     if not table:
         return f"{db_table} not found"
+    if table.get_params().is_projection_enabled():
+        # athena projects the partitions of the table, there's nothing to register
+        return f"{db_table} partitions are projected"
+    partition_inputs = [get_partition_input(table, record) for record in records]
+    existing: list = []
+    rejected: list = []
+    failed: list = []
+    for start in range(0, len(partition_inputs), CREATE_BATCH_SIZE):
+        batch = partition_inputs[start:start + CREATE_BATCH_SIZE]
+        for partition_input, error in retry_failed(
+                lambda items: create_partitions(database_name, table_name, items, existing, rejected),
+                [(partition_input, None) for partition_input in batch],
+                deadline
+        ):
+            failed.append(partition_input['Values'])
+            log.error({
+                'Code': 500,
+                'Message': f'partition {partition_input["Values"]} of {db_table} could not be created: {error}'
+            })
+    updated = update_changed_partitions(database_name, table_name, existing) if existing else []
+    return {
+        'Table': db_table,
+        'Created': len(partition_inputs) - len(existing) - len(rejected) - len(failed),
+        'Updated': len(updated),
+        'Failed': rejected + failed
+    }
+
+def get_partition_input(table, record: dict) -> dict:
+    """
+    Returns the PartitionInput of a partition record, with the storage of its table
+    """
     storage = table.get_storage_descriptor()
-    try:
-        return glue.create_partition(
+    return {
+        'Values': record['values'],
+        'StorageDescriptor': {
+            'Columns': storage['Columns'],
+            'Location': record['location'],
+            'InputFormat': storage['InputFormat'],
+            'OutputFormat': storage['OutputFormat'],
+            'Compressed': storage['Compressed'],
+            'SerdeInfo': storage['SerdeInfo'],
+            'Parameters': storage.get('Parameters', {}),
+            'StoredAsSubDirectories': False
+        },
+        'Parameters': table.get('Parameters', {})
+    }
+
+@backoff.on_exception(backoff.expo, botocore.exceptions.ClientError, max_time=10)
+def create_partitions(database_name: str, table_name: str, items: list, existing: list, rejected: list) -> list:
+    """
+    Creates a batch of (PartitionInput, error) items, appends the ones that already exist to existing
+    and the values of the ones that failed for good to rejected.
+    Returns the ones that failed with a transient error, so that only those are retried
+    """
+    response = glue.batch_create_partition(
+        DatabaseName=database_name,
+        TableName=table_name,
+        PartitionInputList=[partition_input for partition_input, _ in items]
+    )
+    inputs = {tuple(partition_input['Values']): partition_input for partition_input, _ in items}
+    transient: list = []
+    for error in response.get('Errors', []):
+        partition_input = inputs[tuple(error['PartitionValues'])]
+        code = error.get('ErrorDetail', {}).get('ErrorCode')
+        if code == 'AlreadyExistsException':
+            existing.append(partition_input)
+        elif code in TRANSIENT_ERRORS:
+            transient.append((partition_input, code))
+        else:
+            rejected.append(partition_input['Values'])
+            log.error({
+                'Code': 400,
+                'Message': f'partition {partition_input["Values"]} of {database_name}.{table_name} not created: {error.get("ErrorDetail")}'
+            })
+    return transient
+
+@xray_recorder.capture()
+def update_changed_partitions(database_name: str, table_name: str, partition_inputs: list) -> list:
+    """
+    Updates the existing partitions whose storage descriptor differs from the given inputs, returns the updated ones
+    """
+    changed: list = []
+    for start in range(0, len(partition_inputs), GET_BATCH_SIZE):
+        batch = partition_inputs[start:start + GET_BATCH_SIZE]
+        partitions = get_partitions(database_name, table_name, [partition_input['Values'] for partition_input in batch])
+        for partition_input in batch:
+            partition = partitions.get(tuple(partition_input['Values']))
+            if partition and is_changed(partition.get('StorageDescriptor', {}), partition_input['StorageDescriptor']):
+                changed.append(partition_input)
+    if not changed:
+        return []
+    log.info(f'updating {len(changed)} partitions of {database_name}.{table_name}')
+    for start in range(0, len(changed), CREATE_BATCH_SIZE):
+        batch_update_partitions(database_name, table_name, changed[start:start + CREATE_BATCH_SIZE])
+    return changed
+
+def is_changed(storage: dict, new_storage: dict) -> bool:
+    """
+    Returns True if the location, formats or serde library of a partition differ from the ones of its table.
+    The other members, which Glue may fill in or reorder on its own, are left out
+    """
+    serde = storage.get('SerdeInfo', {}).get('SerializationLibrary')
+    if serde != new_storage.get('SerdeInfo', {}).get('SerializationLibrary'):
+        return True
+    return any(storage.get(key) != new_storage.get(key) for key in ('Location', 'InputFormat', 'OutputFormat'))
+
+@backoff.on_exception(backoff.expo, botocore.exceptions.ClientError, max_time=10)
+def get_partitions(database_name: str, table_name: str, values: list) -> dict:
+    """
+    Returns the existing partitions with the given values, by values
+    """
+    partitions: dict = {}
+    to_get = [{'Values': partition_values} for partition_values in values]
+    while to_get:
+        response = glue.batch_get_partition(
             DatabaseName=database_name,
             TableName=table_name,
-            PartitionInput={
-                'Values': values,
-                'StorageDescriptor': {
-                    'Columns': storage['Columns'],
-                    'Location': location,
-                    'InputFormat': storage['InputFormat'],
-                    'OutputFormat': storage['OutputFormat'],
-                    'Compressed': storage['Compressed'],
-                    'SerdeInfo': storage['SerdeInfo'],
-                    'Parameters': storage.get('Parameters', {}),
-                    'StoredAsSubDirectories': False
-                },
-                'Parameters': table.get('Parameters', {})
-            }
+            PartitionsToGet=to_get
         )
-    except glue.exceptions.AlreadyExistsException as ex:
-        # there's already a partition
-        log.info(ex)
+        for partition in response.get('Partitions', []):
+            partitions[tuple(partition['Values'])] = partition
+        to_get = response.get('UnprocessedKeys', [])
+    return partitions
+
+@backoff.on_exception(backoff.expo, botocore.exceptions.ClientError, max_time=10)
+def batch_update_partitions(database_name: str, table_name: str, partition_inputs: list):
+    """
+    Updates a batch of partitions, logging the ones that failed
+    """
+    response = glue.batch_update_partition(
+        DatabaseName=database_name,
+        TableName=table_name,
+        Entries=[
+            {
+                'PartitionValueList': partition_input['Values'],
+                'PartitionInput': partition_input
+            } for partition_input in partition_inputs
+        ]
+    )
+    for error in response.get('Errors', []):
+        log.error({
+            'Code': 500,
+            'Message': f'partition {error.get("PartitionValueList")} of {database_name}.{table_name} not updated: {error.get("ErrorDetail")}'
+        })
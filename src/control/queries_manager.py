@@ -0,0 +1,51 @@
+"""
+Track the Athena queries submitted through lib.athena, and start the queued ones as running ones finish
+"""
+import os
+import logging
+from datetime import datetime
+
+import aws_lambda_logging
+from aws_xray_sdk.core import patch_all, xray_recorder
+
+from lib.athena import FAILED, RUNNING, drain, poll_running, update_query
+from lib.compactions import retry_compactions
+
+# pylint: disable=invalid-name, line-too-long, unused-argument
+
+patch_all()  # for xray tracing of boto libs
+log = logging.getLogger()
+
+@xray_recorder.capture()
+def handler(event, context):
+    """
+    Invoked on Athena query state changes, on submissions and on schedule, one invocation at a time.
+    Records the final state of the finished query, or polls the running ones on schedule, then drains the queue.
+    The compactions of the queries that failed for good are scheduled again, succeeded ones are linked by the partitions linker
+    """
+    aws_lambda_logging.setup(
+        level=os.environ.get('LOGLEVEL', 'INFO'),
+        aws_request_id=context.aws_request_id,
+        boto_level='CRITICAL'
+    )
+    source = event.get('source')
+    updated: list = []
+    if source == 'aws.athena':
+        detail = event.get('detail', {})
+        result = update_query(detail.get('queryExecutionId'), detail.get('currentState'))
+        if result:
+            updated.append(result)
+    elif source == 'aws.events':
+        updated.extend(poll_running())
+    drained = drain()
+    now = datetime.utcnow()
+    result = {
+        'Updated': [(item['query_id'], item['state']) for item in updated],
+        'Started': [(item['query_id'], item['execution_id']) for item in drained if item['state'] == RUNNING],
+        'Retried': [
+            retry_compactions(item['context']['tmptable'], now)
+            for item in updated + drained if item['state'] == FAILED and item.get('context', {}).get('tmptable')
+        ]
+    }
+    log.info(result)
+    return result
@@ -1,21 +1,35 @@
 """
-Listen to the DynamoDB stream for partition events and dispatch them as CloudWatch custom events
+Listen to the DynamoDB stream for partition events and dispatch them as CloudWatch custom events,
+or straight to the ControlStream in the same shape as delivered by the CloudWatch rule
 """
+import os
 import json
 import logging
 from datetime import datetime
+from uuid import uuid4
 
+import backoff
 import boto3
+import botocore
 from boto3.dynamodb.types import TypeDeserializer
 
 from aws_xray_sdk.core import patch_all, xray_recorder
 
+from lib.batches import pack, retry_failed, get_deadline, EVENTS_LIMITS, KINESIS_LIMITS
 from lib.decorators import DynamoRecord, dynamo_handler
+from lib.producer import aggregate, sizeof as sizeof_record
+from lib.partitions import is_touch
 
 # pylint: disable=invalid-name, line-too-long, unused-argument
 
 patch_all()  # for xray tracing of boto libs
 cwe = boto3.client('events')
+kinesis = boto3.client('kinesis')
+# events goes through CloudWatch events and the CustomEventRule, stream puts the events in the ControlStream directly
+PUBLISH_MODE = os.environ.get('PUBLISH_MODE', 'events')
+CONTROL_STREAM = os.environ.get('CONTROL_STREAM')
+SOURCE = 'custom.partition.event'
+DETAIL_TYPE = 'Partition State Change'
 
 log = logging.getLogger()
 
@@ -24,29 +38,152 @@ json.JSONEncoder.default = lambda self, obj: (obj.isoformat() if isinstance(obj,
 @dynamo_handler(event_types=[
     DynamoRecord.INSERT,
     DynamoRecord.MODIFY
-])
+], batch_size=None)
 @xray_recorder.capture()
 def handler(dynamo_records, context):
     """
     Listen to the DynamoDB stream for partition events and dispatch them as CloudWatch custom events
+    The events of the whole stream batch are packed in as few calls as the API limits allow
     """
     deserializer = TypeDeserializer()
-    record = dynamo_records[0]
-    item = {
-        key: deserializer.deserialize(value) for d in [record['dynamodb']['NewImage'], record['dynamodb']['Keys']] for key, value in d.items()
+    items: list = []
+    for record in dynamo_records:
+        item = {
+            key: deserializer.deserialize(value) for d in [record['dynamodb']['NewImage'], record['dynamodb']['Keys']] for key, value in d.items()
+        }
+        old_item = {
+            key: deserializer.deserialize(value) for key, value in record['dynamodb'].get('OldImage', {}).items()
+        }
+        if is_touch(old_item, item):
+            # objects landing in an open partition change no state, there's nothing to dispatch
+            continue
+        items.append(item)
+    if not items:
+        return None
+
+    deadline = get_deadline(context)
+    if PUBLISH_MODE == 'stream':
+        return publish_records(items, context, deadline)
+    return publish_events(items, deadline)
+
+def publish_events(items: list, deadline: float) -> str:
+    """
+    Sends the partition events to CloudWatch events in as few PutEvents calls as the limits allow
+    """
+    entries = [get_entry(item) for item in items]
+    oversized: list = []
+    failed = [
+        entry
+        for batch in pack(entries, EVENTS_LIMITS, sizeof=sizeof, oversized=oversized)
+        for entry in retry_failed(put_events, batch, deadline)
+    ]
+    for entry in oversized:
+        log.error({
+            'Code': 413,
+            'Message': f'partition event of {sizeof(entry)} bytes is over the PutEvents limit: {entry["Detail"][:1024]}'
+        })
+    if failed:
+        # failing the invocation has the stream retry the batch, rather than losing the partition events
+        raise RuntimeError(f'{len(failed)} of {len(entries)} partition events could not be published')
+    return f'{len(entries) - len(oversized)} partition events published'
+
+def publish_records(items: list, context, deadline: float) -> str:
+    """
+    Puts the partition events in the ControlStream wrapped as CloudWatch events, aggregated by partition key.
+    Keys are the event type, matched by the consumers, followed by the table, so that the events of a table stay ordered
+    """
+    _, _, _, region, account, _ = context.invoked_function_arn.split(':', 5)
+    records = [
+        (f'{get_event_type(item)}:{item.get("db_table", "")}', json.dumps(to_event(item, region, account)))
+        for item in items
+    ]
+    oversized: list = []
+    failed = [
+        record
+        for batch in pack(aggregate(records), KINESIS_LIMITS, sizeof=sizeof_record, oversized=oversized)
+        for record in retry_failed(put_records, batch, deadline)
+    ]
+    if oversized:
+        log.error({
+            'Code': 413,
+            'Message': f'{len(oversized)} aggregated partition events are over the PutRecords limit'
+        })
+    if failed:
+        raise RuntimeError(f'{len(failed)} aggregated partition events could not be published to {CONTROL_STREAM}')
+    return f'{len(items)} partition events published to {CONTROL_STREAM}'
+
+def get_event_type(item: dict) -> str:
+    """
+    Returns the event type of a partition item, matched by the consumers of the ControlStream
+    """
+    return f'custom.event.partition.{item["state"]}'
+
+def get_detail(item: dict) -> dict:
+    """
+    Returns the detail of the event of a partition item
+    """
+    return {
+        'Event': get_event_type(item),
+        'Record': item
+    }
+
+def to_event(item: dict, region: str, account: str) -> dict:
+    """
+    Returns the event of a partition item as delivered by the CustomEventRule to the ControlStream
+    """
+    return {
+        'version': '0',
+        'id': str(uuid4()),
+        'detail-type': DETAIL_TYPE,
+        'source': SOURCE,
+        'account': account,
+        'time': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'region': region,
+        'resources': [],
+        'detail': get_detail(item)
+    }
+
+def get_entry(item: dict) -> dict:
+    """
+    Returns the PutEvents entry of a partition item
+    """
+    return {
+        'Source': SOURCE,
+        'DetailType': DETAIL_TYPE,
+        'Detail': json.dumps(get_detail(item))
     }
 
-    return cwe.put_events(
-        Entries=[
-            {
-                'Source': 'custom.partition.event',
-                'DetailType': 'Partition State Change',
-                'Detail': json.dumps(
-                    {
-                        'Event': f'custom.event.partition.{item["state"]}',
-                        'Record': item
-                    }
-                )
-            }
+def sizeof(entry: dict) -> int:
+    """
+    Returns the size of a PutEvents entry as accounted by EventBridge
+    """
+    return sum(len(entry[key].encode('utf-8')) for key in ('Source', 'DetailType', 'Detail'))
+
+@backoff.on_exception(backoff.expo, botocore.exceptions.ClientError, max_time=10)
+def put_events(entries: list) -> list:
+    """
+    Sends a batch of PutEvents entries, returns the ones that failed
+    """
+    result = cwe.put_events(Entries=entries)
+    if result.get('FailedEntryCount'):
+        return [
+            entries[i] for i, response in enumerate(result['Entries'])
+            if 'ErrorCode' in response
         ]
+    return []
+
+@backoff.on_exception(backoff.expo, botocore.exceptions.ClientError, max_time=10)
+def put_records(entries: list) -> list:
+    """
+    Sends a batch of PutRecords entries to the ControlStream, returns the ones that failed
+    """
+    result = kinesis.put_records(
+        StreamName=CONTROL_STREAM,
+        Records=entries
     )
+    if result.get('FailedRecordCount'):
+        return [
+            entries[i] for i, response in enumerate(result['Records'])
+            if 'ErrorCode' in response
+        ]
+    return []
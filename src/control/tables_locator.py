@@ -30,49 +30,65 @@ json.JSONEncoder.default = lambda self, obj: (obj.isoformat() if isinstance(obj,
 @xray_recorder.capture()
 @kinesis_handler(event_types=[
     KinesisRecord.GLUE_SOURCE_EVENT
-])
+], batch_size=None)
 def handler(kinesis_records, context):
     """
     Listen to CloudTrail Glue events, and map in dynamodb the location of the Glue Table
     """
-    detail = kinesis_records[0].parse().get('detail')
-    if detail.get('typeOfChange') == 'CreateTable':
-        tables = detail.get('changedTables')
-        database_name = detail.get('databaseName')
-        if database_name != TMP_DATABASE:
-            return [insert_location(database_name, table_name) for table_name in tables]
+    tables: list = []
+    for kinesis_record in kinesis_records:
+        detail = kinesis_record.parse().get('detail')
+        if detail.get('typeOfChange') == 'CreateTable':
+            database_name = detail.get('databaseName')
+            if database_name != TMP_DATABASE:
+                tables.extend([(database_name, table_name) for table_name in detail.get('changedTables')])
+    if tables:
+        return insert_locations(tables)
     return None
 
 @xray_recorder.capture()
 @backoff.on_exception(backoff.expo, botocore.exceptions.ClientError, max_time=10)
-def insert_location(database_name: str, table_name: dict):
+def insert_locations(tables: list):
     """
-    Insert location of Glue Table
+    Insert locations of a batch of (database, table) Glue Tables
+    """
+    batch_items = [
+        batch_item for database_name, table_name in tables for batch_item in get_locations(database_name, table_name)
+    ]
+    log.info(batch_items)
+    if batch_items:
+        with dynamodb.Table(GLUE_TABLES_LOCATOR).batch_writer(overwrite_by_pkeys=['location']) as batch:
+            for batch_item in batch_items:
+                batch.put_item(Item=batch_item)
+    return batch_items
+
+def get_locations(database_name: str, table_name: str) -> list:
+    """
+    Returns the location items of Glue Table
     """
     table = get_glue_table(database_name, table_name)
     if not table:
-        return
+        return []
     log.info(table.dump())
     bucket = table.get_table_bucket()
     if bucket != DATA_BUCKET:
-        return
+        return []
     table_prefix = table.get_table_prefix()
+    # lets the partitions mappers load only the locations updated since their last scan
+    updated = datetime.utcnow().isoformat()
     batch_items = [{
         'location': f's3://{bucket}/{table_prefix}',
         'database_name': database_name,
         'table_name': table_name,
         'partition_keys': table.get_partition_keys(),
-        'is_simlinked': table.is_symlinked()
+        'is_simlinked': table.is_symlinked(),
+        'updated': updated
     }]
     firehose_target = table.get_firehose_target()
     if firehose_target != table_prefix:
         batch_items.append({
             'location': f's3://{bucket}/{firehose_target}',
-            'symlink': f's3://{bucket}/{table_prefix}'
+            'symlink': f's3://{bucket}/{table_prefix}',
+            'updated': updated
         })
-    log.info(batch_items)
-    if batch_items:
-        with dynamodb.Table(GLUE_TABLES_LOCATOR).batch_writer() as batch:
-            for batch_item in batch_items:
-                batch.put_item(Item=batch_item)
     return batch_items
@@ -6,15 +6,25 @@ import os
 import logging
 import base64
 import json
+import multiprocessing
 
+import botocore
 from aws_xray_sdk.core import xray_recorder
 from aws_xray_sdk.core import patch_all
 import aws_lambda_logging
 
+from lib.glue import get_glue_table
+from lib.schema import get_columns, project
+
 # pylint: disable=invalid-name, line-too-long, unused-argument, broad-except, logging-fstring-interpolation
 
 patch_all()  # for xray tracing of boto libs
 log = logging.getLogger()
+FIREHOSE_MEMBER = b'"firehose"'
+# number of processes transforming an invocation, 0 or 1 keeps the transformation in process
+TRANSFORM_WORKERS = int(os.environ.get('TRANSFORM_WORKERS', '0'))
+# invocations with fewer records are always transformed in process
+TRANSFORM_PARALLEL_MIN_RECORDS = int(os.environ.get('TRANSFORM_PARALLEL_MIN_RECORDS', '1000'))
 
 @xray_recorder.capture()
 def handler(event, context):
@@ -28,18 +38,76 @@ def handler(event, context):
     )
     received_raw_firehose_records = event['records']
     log.info(f'Received {len(received_raw_firehose_records)} events')
-   
+    columns = get_projection(event.get('deliveryStreamArn'))
+
+    if TRANSFORM_WORKERS > 1 and len(received_raw_firehose_records) >= TRANSFORM_PARALLEL_MIN_RECORDS:
+        return {
+            'records' : parallel_transform(received_raw_firehose_records, TRANSFORM_WORKERS, columns)
+        }
     return {
         'records' : [
-            transform(firehose_record)
+            transform(firehose_record, columns)
             for firehose_record in received_raw_firehose_records
         ]
     }
 
-@xray_recorder.capture()
-def transform(firehose_record: dict):
+def get_projection(delivery_stream_arn: str) -> dict:
     """
-    Add firehose metadata to the source record
+    Returns the columns of the table behind the firehose when it opted in projecting its records, None otherwise
+    """
+    stream_name = (delivery_stream_arn or '').rsplit('/', 1)[-1]
+    if '.' not in stream_name:
+        return None
+    database_name, table_name = stream_name.split('.', 1)
+    try:
+        table = get_glue_table(database_name, table_name)
+    except botocore.exceptions.ClientError as ex:
+        log.error(ex)
+        return None
+    if table and table.get_params().is_processors_projection():
+        return get_columns(table)
+    return None
+
+def parallel_transform(firehose_records: list, workers: int, columns: dict = None) -> list:
+    """
+    Split the records in chunks, and transform them on child processes while this one takes the last chunk.
+    Results come back over pipes, as Lambda has no /dev/shm for the semaphores behind multiprocessing.Pool and Queue,
+    and are joined in the original recordId order
+    """
+    size = -(-len(firehose_records) // workers)
+    chunks = [firehose_records[start:start + size] for start in range(0, len(firehose_records), size)]
+    jobs: list = []
+    for chunk in chunks[:-1]:
+        receiver, sender = multiprocessing.Pipe(duplex=False)
+        process = multiprocessing.Process(target=transform_chunk, args=(chunk, columns, sender))
+        process.start()
+        sender.close()
+        jobs.append((chunk, process, receiver))
+    last = [transform(firehose_record, columns) for firehose_record in chunks[-1]]
+
+    transformed: list = []
+    for chunk, process, receiver in jobs:
+        try:
+            transformed.extend(receiver.recv())
+        except EOFError:
+            # the worker died without a result, transform its chunk here instead
+            log.error(f'transform worker {process.pid} failed, transforming {len(chunk)} records in process')
+            transformed.extend([transform(firehose_record, columns) for firehose_record in chunk])
+        receiver.close()
+        process.join()
+    transformed.extend(last)
+    return transformed
+
+def transform_chunk(firehose_records: list, columns: dict, sender):
+    """
+    Transform a chunk of records in a child process, and send the results back to the parent
+    """
+    sender.send([transform(firehose_record, columns) for firehose_record in firehose_records])
+    sender.close()
+
+def transform(firehose_record: dict, columns: dict = None):
+    """
+    Add firehose metadata to the source record, or project it on the table columns if given
     """
     transformed = {
         'recordId': firehose_record['recordId'],
@@ -47,13 +115,54 @@ def transform(firehose_record: dict):
         'data' : firehose_record['data']
     }
     try:
-        data = json.loads(base64.b64decode(firehose_record['data']))
-        data['firehose'] = {
+        raw = base64.b64decode(firehose_record['data'])
+        metadata = {
             'record_id': firehose_record['recordId'],
             'timestamp': firehose_record['approximateArrivalTimestamp']
         }
-        transformed['data'] = base64.b64encode(json.dumps(data).encode("utf-8")).decode('utf-8')
+        data = add_metadata(raw, metadata) if columns is None else project_record(raw, metadata, columns)
+        transformed['data'] = base64.b64encode(data).decode('utf-8')
         transformed['result'] = 'Ok'
     except Exception as ex:
         log.error(ex)
     return transformed
+
+def add_metadata(raw: bytes, metadata: dict) -> bytes:
+    """
+    Returns the raw json record with the metadata added as its firehose member.
+    The record is parsed to reject it if malformed, but a plain object is spliced rather than serialized again
+    """
+    data = json.loads(raw)
+    if isinstance(data, dict) and 'firehose' not in data:
+        spliced = splice(raw, json.dumps(metadata).encode('utf-8'))
+        if spliced:
+            return spliced
+    return merge(data, metadata)
+
+def splice(raw: bytes, metadata: bytes) -> bytes:
+    """
+    Appends the metadata as the last member of a json object already validated, without serializing it again.
+    Returns None if raw isn't delimited by the braces of the object, as in other encodings than utf-8
+    """
+    body = raw.strip()
+    if body[:1] != b'{' or body[-1:] != b'}':
+        return None
+    head = body[:-1].rstrip()
+    return head + (b'' if head == b'{' else b', ') + FIREHOSE_MEMBER + b': ' + metadata + b'}'
+
+def merge(data, metadata: dict) -> bytes:
+    """
+    Sets the metadata as the firehose member of the parsed json record
+    """
+    data['firehose'] = metadata
+    return json.dumps(data).encode('utf-8')
+
+def project_record(raw: bytes, metadata: dict, columns: dict) -> bytes:
+    """
+    Parses the json record, keeps only the declared columns with their values coerced to the column types,
+    and sets the metadata as its firehose member if the table declares it
+    """
+    data = project(json.loads(raw), columns)
+    if 'firehose' in columns:
+        data['firehose'] = metadata
+    return json.dumps(data).encode('utf-8')
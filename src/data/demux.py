@@ -2,23 +2,35 @@
 Demultiplex a Kinesis Firehose Event sent to this stream to the corresponding firehose
 """
 import os
+import json
 import logging
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from uuid import uuid4
 
 import backoff
 import boto3
 import botocore
+from botocore.config import Config
 from aws_xray_sdk.core import patch_all, xray_recorder
 
+from lib.batches import pack, retry_failed, get_deadline, FIREHOSE_LIMITS, KINESIS_LIMITS
 from lib.decorators import kinesis_handler, KinesisRecord
+from lib.s3 import upload_file
 
 # pylint: disable=invalid-name, line-too-long, unused-argument
 
 patch_all()  # for xray tracing of boto libs
-kinesis = boto3.client('kinesis')
-firehose = boto3.client('firehose')
 log = logging.getLogger()
 DATA_STREAM = os.environ.get('DATA_STREAM')
+DATA_BUCKET = os.environ.get('DATA_BUCKET')
+DEAD_LETTER_PREFIX = os.environ.get('DEAD_LETTER_PREFIX', 'errors/demux/')
+# number of firehoses published to concurrently, the firehose client connection pool is sized to match
+FANOUT_WORKERS = int(os.environ.get('FANOUT_WORKERS', '10'))
+kinesis = boto3.client('kinesis')
+firehose = boto3.client('firehose', config=Config(max_pool_connections=FANOUT_WORKERS))
+executor = ThreadPoolExecutor(max_workers=FANOUT_WORKERS)
 
 @xray_recorder.capture()
 @kinesis_handler(event_types=[
@@ -27,8 +39,11 @@ DATA_STREAM = os.environ.get('DATA_STREAM')
 def handler(kinesis_records, context):
     """
     Fan out records in batches to the firehose based on the partition key prefix
-    Failed records are requed back into the stream for later reprocessing.
+    Batches for different firehoses are published concurrently, results are collected in submission order.
+    Records still failing after the retries are requed back into the stream in bulk for later reprocessing,
+    and the ones that can't be requeued either are spilled to the dead letter prefix.
     """
+    deadline = get_deadline(context)
     res = defaultdict(list)
     for record in kinesis_records:
         res[record.get_evaluated_match()[3]].append(record)
@@ -36,36 +51,60 @@ def handler(kinesis_records, context):
     batches = [
         {'firehose': key, 'records': value} for key, value in res.items()
     ]
-    results = [
-        publish_batch(entry['firehose'], entry['records']) for entry in batches
-    ]
+    results = executor.map(
+        lambda entry: publish_batch(entry['firehose'], entry['records'], deadline), batches
+    )
 
-    for failed_batch in results:
-        for failed_record in failed_batch:
-            log.warning({
-                "Message" : "Requeing record",
-                "Record" : failed_record.dump()
-            })
-            reque(failed_record)
+    failed_records = [
+        failed_record for failed_batch in results for failed_record in failed_batch
+    ]
+    if failed_records:
+        log.warning({
+            "Message" : f"Requeing {len(failed_records)} records",
+            "Records" : [failed_record['kinesis']['sequenceNumber'] for failed_record in failed_records]
+        })
+        dead_letter(reque(failed_records, deadline), 'unprocessed')
     return "Success"
 
+@xray_recorder.capture()
+def publish_batch(target: str, records: list, deadline: float) -> list:
+    """
+    Send payload to target firehose, split in as many requests as needed to fit the PutRecordBatch limits.
+    Only the failed entries of a request are resent, the records still failing are returned.
+    Records too large for firehose are spilled to the dead letter prefix, as no retry would ever succeed
+    """
+    oversized: list = []
+    entries = ((record, record.decode()) for record in records)
+    failed = [
+        failed_record
+        for batch in pack(entries, FIREHOSE_LIMITS, sizeof=lambda entry: len(entry[1]), oversized=oversized)
+        for failed_record, _ in retry_failed(lambda items: put_record_batch(target, items), batch, deadline)
+    ]
+    if oversized:
+        log.error({
+            'Code' : 413,
+            'Message': f'{len(oversized)} records exceed the firehose {target} record limit'
+        })
+        dead_letter([record for record, _ in oversized], f'oversized/{target}')
+    return failed
+
 @xray_recorder.capture()
 @backoff.on_exception(backoff.expo, botocore.exceptions.ClientError, max_time=10)
-def publish_batch(target: str, records: list) -> dict:
+def put_record_batch(target: str, batch: list) -> list:
     """
-    Send payload to target firehose
+    Send a batch of (record, data) entries to target firehose, returns the entries that failed
     """
     try:
         result = firehose.put_record_batch(
             DeliveryStreamName=target,
             Records=[{
-                'Data': record.decode()
-            } for record in records]
+                'Data': data
+            } for _, data in batch]
         )
         if result.get('FailedPutCount'):
             return [
-                records[i] for i, record in enumerate(result['RequestResponses'])
-                if "ErrorCode" in record
+                batch[i] for i, response in enumerate(result['RequestResponses'])
+                if "ErrorCode" in response
             ]
     except firehose.exceptions.ResourceNotFoundException as ex:
         # it wasn't meant for a firehose after all
@@ -83,13 +122,52 @@ def publish_batch(target: str, records: list) -> dict:
         })
     return []
 
+@xray_recorder.capture()
+def reque(records: list, deadline: float) -> list:
+    """
+    Requeue records back into the stream with their original partition keys, in PutRecords batches.
+    Returns the records that could not be requeued
+    """
+    entries = ((record, record.decode()) for record in records)
+    return [
+        failed_record
+        for batch in pack(entries, KINESIS_LIMITS, sizeof=lambda entry: len(entry[1]) + len(entry[0]['kinesis']['partitionKey']))
+        for failed_record, _ in retry_failed(put_records, batch, deadline)
+    ]
 
 @xray_recorder.capture()
 @backoff.on_exception(backoff.expo, botocore.exceptions.ClientError, max_time=10)
-def reque(record):
-    kinesis.put_record(
+def put_records(batch: list) -> list:
+    """
+    Send a batch of (record, data) entries to the data stream, returns the entries that failed
+    """
+    result = kinesis.put_records(
         StreamName=DATA_STREAM,
-        Data=record.decode(),
-        PartitionKey=record['kinesis']['partitionKey']
+        Records=[{
+            'Data': data,
+            'PartitionKey': record['kinesis']['partitionKey']
+        } for record, data in batch]
+    )
+    if result.get('FailedRecordCount'):
+        return [
+            batch[i] for i, response in enumerate(result['Records'])
+            if "ErrorCode" in response
+        ]
+    return []
+
+@xray_recorder.capture()
+def dead_letter(records: list, reason: str):
+    """
+    Spill undeliverable records to the dead letter prefix, one json document per line
+    """
+    if not records:
+        return None
+    location = f's3://{DATA_BUCKET}/{DEAD_LETTER_PREFIX}{reason}/{datetime.utcnow():%Y/%m/%d/%H}/{uuid4()}.json'
+    log.error({
+        'Code' : 500,
+        'Message': f'{len(records)} records spilled to {location}'
+    })
+    return upload_file(
+        location,
+        '\n'.join([json.dumps(record.dump()) for record in records]).encode('utf-8')
     )
-    
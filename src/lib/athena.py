@@ -1,20 +1,44 @@
 import json
 import os
+import re
 import logging
-import backoff
+from datetime import datetime, timedelta
+from uuid import uuid4
 
+import backoff
 import boto3
 import botocore
+from boto3.dynamodb.conditions import Key
 from aws_xray_sdk.core import xray_recorder
 from aws_xray_sdk.core import patch_all
 
-# pylint: disable=invalid-name, line-too-long, unused-argument
+from lib.partitions import read_all
+
+# pylint: disable=invalid-name, line-too-long, unused-argument, logging-fstring-interpolation
 
 log = logging.getLogger()
 
 patch_all()  # for xray tracing of boto libs
 
 athena = boto3.client('athena')
+dynamodb = boto3.resource('dynamodb')
+lambda_client = boto3.client('lambda')
+
+# queries submitted through the manager are tracked in this table, and started by the QUERIES_MANAGER function
+ATHENA_QUERIES = os.environ.get('ATHENA_QUERIES')
+QUERIES_MANAGER = os.environ.get('QUERIES_MANAGER')
+# queries started by the manager and not finished yet, below the account DML concurrency so that adhoc queries still run
+MAX_RUNNING_QUERIES = int(os.environ.get('MAX_RUNNING_QUERIES', '10'))
+# attempts of a query failing with a transient error
+MAX_QUERY_ATTEMPTS = int(os.environ.get('MAX_QUERY_ATTEMPTS', '3'))
+QUERIES_RETENTION_DAYS = 7
+EPOCH = datetime.utcfromtimestamp(0)
+QUEUED = 'queued'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+# failure reasons worth running the query again
+TRANSIENT_FAILURES = re.compile(r'ThrottlingException|Rate exceeded|TOO_MANY_REQUESTS|SlowDown|reduce your request rate|internal error|INTERNAL_ERROR|Query exhausted resources', re.IGNORECASE)
 
 @xray_recorder.capture()
 @backoff.on_exception(backoff.expo, botocore.exceptions.ClientError, max_time=10)
@@ -37,3 +61,214 @@ def execute_query(query, bucket):
     except athena.exceptions.InvalidRequestException as ex:
         log.error(ex)
 
+@xray_recorder.capture()
+@backoff.on_exception(backoff.expo, botocore.exceptions.ClientError, max_time=10)
+def submit_query(query: str, bucket: str, context: dict = None) -> dict:
+    """
+    Queue a query for the manager, which starts it once fewer than MAX_RUNNING_QUERIES are running.
+    The context is kept with the query for the handlers of its completion. Returns the queued item
+    """
+    timestamp = datetime.utcnow().isoformat()
+    item = {
+        'query_id': uuid4().hex,
+        'state': QUEUED,
+        'query': ' '.join(query.replace('\n', ' ').split()),
+        'bucket': bucket,
+        'context': context or {},
+        'attempts': 0,
+        'submitted': timestamp,
+        'updated': timestamp
+    }
+    dynamodb.Table(ATHENA_QUERIES).put_item(Item=item)
+    notify_manager()
+    return item
+
+def notify_manager():
+    """
+    Asynchronously invoke the manager to start the queued queries now, rather than on its next schedule
+    """
+    if not QUERIES_MANAGER:
+        return
+    try:
+        lambda_client.invoke(
+            FunctionName=QUERIES_MANAGER,
+            InvocationType='Event',
+            Payload=json.dumps({'source': 'custom.athena.submit'})
+        )
+    except botocore.exceptions.ClientError as ex:
+        # the schedule drains the queue anyway
+        log.warning(ex)
+
+@xray_recorder.capture()
+def drain() -> list:
+    """
+    Start the oldest queued queries while fewer than MAX_RUNNING_QUERIES are running.
+    Meant to be called from a single manager at a time. Returns the started queries, and the ones athena rejected
+    """
+    slots = MAX_RUNNING_QUERIES - count_queries(RUNNING)
+    drained: list = []
+    if slots <= 0:
+        return drained
+    for item in get_queries(QUEUED, limit=slots):
+        updated = start_query(item)
+        if updated is None:
+            # athena is at capacity, the remaining queries wait for the next drain
+            break
+        if updated.get('state') in (RUNNING, FAILED):
+            drained.append(updated)
+    started = len([item for item in drained if item['state'] == RUNNING])
+    log.info(f'{started} queries started, {slots - started} free slots')
+    return drained
+
+@backoff.on_exception(backoff.expo, botocore.exceptions.ClientError, max_time=10)
+def count_queries(state: str) -> int:
+    """
+    Returns the number of queries in the given state
+    """
+    return len(read_all(
+        dynamodb.Table(ATHENA_QUERIES).query,
+        IndexName='state-index',
+        KeyConditionExpression=Key('state').eq(state),
+        ProjectionExpression='query_id'
+    ))
+
+@backoff.on_exception(backoff.expo, botocore.exceptions.ClientError, max_time=10)
+def get_queries(state: str, limit: int = None) -> list:
+    """
+    Returns the queries in the given state, oldest submission first, at most limit of them
+    """
+    return read_all(
+        dynamodb.Table(ATHENA_QUERIES).query,
+        limit=limit,
+        IndexName='state-index',
+        KeyConditionExpression=Key('state').eq(state)
+    )
+
+@xray_recorder.capture()
+def start_query(item: dict):
+    """
+    Start a queued query and mark it running. Returns the updated item, or None if Athena is at capacity
+    """
+    xray_recorder.current_subsegment().put_metadata(
+        "statement", item['query'], "athena"
+    )
+    try:
+        execution_id = athena.start_query_execution(
+            QueryString=item['query'],
+            ResultConfiguration={
+                'OutputLocation': f's3://{item["bucket"]}/athena',
+                'EncryptionConfiguration': {
+                    'EncryptionOption': "SSE_S3"
+                }
+            }
+        )['QueryExecutionId']
+    except athena.exceptions.TooManyRequestsException as ex:
+        log.warning(ex)
+        return None
+    except athena.exceptions.InvalidRequestException as ex:
+        log.error(ex)
+        return set_state(item, QUEUED, FAILED, reason=str(ex)) or {}
+    return set_state(item, QUEUED, RUNNING, execution_id=execution_id, attempts=int(item.get('attempts', 0)) + 1) or {}
+
+@backoff.on_exception(backoff.expo, botocore.exceptions.ClientError, max_time=10)
+def get_query(execution_id: str):
+    """
+    Returns the managed query of an execution id, or None if it wasn't submitted through the manager
+    """
+    items = dynamodb.Table(ATHENA_QUERIES).query(
+        IndexName='execution-index',
+        KeyConditionExpression=Key('execution_id').eq(execution_id)
+    ).get('Items')
+    return items[0] if items else None
+
+@xray_recorder.capture()
+def update_query(execution_id: str, athena_state: str, reason: str = None):
+    """
+    Record the final state of a query execution. Transient failures put the query back in the queue,
+    until it has been attempted MAX_QUERY_ATTEMPTS times. Returns the updated item, or None if nothing changed
+    """
+    if athena_state not in ('SUCCEEDED', 'FAILED', 'CANCELLED'):
+        return None
+    item = get_query(execution_id)
+    if not item or item['state'] != RUNNING or item.get('execution_id') != execution_id:
+        return None
+    if athena_state == 'SUCCEEDED':
+        return set_state(item, RUNNING, SUCCEEDED)
+    if reason is None:
+        reason = get_state_change_reason(execution_id)
+    if athena_state == 'FAILED' and TRANSIENT_FAILURES.search(reason or '') and int(item.get('attempts', 0)) < MAX_QUERY_ATTEMPTS:
+        log.warning(f'query {item["query_id"]} failed with a transient error, queued again: {reason}')
+        return set_state(item, RUNNING, QUEUED, reason=reason)
+    log.error({
+        'Code': 500,
+        'Message': f'query {item["query_id"]} {athena_state.lower()}: {reason}'
+    })
+    return set_state(item, RUNNING, FAILED, reason=reason)
+
+@backoff.on_exception(backoff.expo, botocore.exceptions.ClientError, max_time=10)
+def get_state_change_reason(execution_id: str) -> str:
+    """
+    Returns the reason of the last state change of a query execution
+    """
+    return athena.get_query_execution(
+        QueryExecutionId=execution_id
+    )['QueryExecution']['Status'].get('StateChangeReason', '')
+
+@xray_recorder.capture()
+def poll_running() -> list:
+    """
+    Update the running queries from their Athena status, in case their state change event was missed.
+    Returns the updated items
+    """
+    running = {item['execution_id']: item for item in get_queries(RUNNING) if item.get('execution_id')}
+    execution_ids = list(running)
+    updated: list = []
+    for start in range(0, len(execution_ids), 50):
+        for execution in get_query_executions(execution_ids[start:start + 50]):
+            status = execution['Status']
+            result = update_query(execution['QueryExecutionId'], status['State'], status.get('StateChangeReason', ''))
+            if result:
+                updated.append(result)
+    return updated
+
+@backoff.on_exception(backoff.expo, botocore.exceptions.ClientError, max_time=10)
+def get_query_executions(execution_ids: list) -> list:
+    """
+    Returns the query executions of up to 50 execution ids
+    """
+    return athena.batch_get_query_execution(
+        QueryExecutionIds=execution_ids
+    ).get('QueryExecutions', [])
+
+@backoff.on_exception(backoff.expo, botocore.exceptions.ClientError, max_time=10)
+def set_state(item: dict, from_state: str, to_state: str, **attributes):
+    """
+    Conditionally move a query from a state to another, setting the given attributes.
+    Returns the updated item, or None if the query was no longer in from_state
+    """
+    now = datetime.utcnow()
+    attributes['state'] = to_state
+    attributes['updated'] = now.isoformat()
+    if to_state in (SUCCEEDED, FAILED):
+        # finished queries are kept for a while for their completion handlers and troubleshooting
+        attributes['expiry'] = int((now + timedelta(days=QUERIES_RETENTION_DAYS) - EPOCH).total_seconds())
+    names = {f'#{name}': name for name in attributes}
+    values = {f':{name}': value for name, value in attributes.items()}
+    values[':from_state'] = from_state
+    update = 'SET ' + ', '.join(f'#{name} = :{name}' for name in attributes)
+    if to_state == QUEUED:
+        # the query is retried as a new execution
+        update += ' REMOVE #execution_id'
+        names['#execution_id'] = 'execution_id'
+    try:
+        return dynamodb.Table(ATHENA_QUERIES).update_item(
+            Key={'query_id': item['query_id']},
+            UpdateExpression=update,
+            ConditionExpression='#state = :from_state',
+            ExpressionAttributeNames=names,
+            ExpressionAttributeValues=values,
+            ReturnValues='ALL_NEW'
+        ).get('Attributes')
+    except dynamodb.meta.client.exceptions.ConditionalCheckFailedException:
+        log.info(f'query {item["query_id"]} is no longer {from_state}')
+        return None
@@ -0,0 +1,66 @@
+"""
+Packs records in batches honouring the request limits of the AWS batch APIs,
+and resends the entries that failed within a batch
+"""
+import random
+import time
+from collections import namedtuple
+
+# pylint: disable=invalid-name, line-too-long
+
+Limits = namedtuple('Limits', ['count', 'size', 'record_size'])
+
+# PutRecordBatch accepts 500 records and 4 MiB per request, and 1,000 KiB per record
+FIREHOSE_LIMITS = Limits(count=500, size=4 * 1024 * 1024, record_size=1000 * 1024)
+# PutRecords accepts 500 records and 5 MiB per request, and 1 MiB per record
+KINESIS_LIMITS = Limits(count=500, size=5 * 1024 * 1024, record_size=1024 * 1024)
+# PutEvents accepts 10 entries and 256 KB per request, whatever the number of entries
+EVENTS_LIMITS = Limits(count=10, size=256 * 1024, record_size=256 * 1024)
+
+
+def pack(items, limits: Limits, sizeof=len, oversized: list = None):
+    """
+    Lazily packs an iterable of items in a sequence of lists that fit the given limits.
+    Items larger than the record limit are left out, and appended to oversized if provided
+    """
+    batch: list = []
+    batch_size = 0
+    for item in items:
+        size = sizeof(item)
+        if size > limits.record_size:
+            if oversized is not None:
+                oversized.append(item)
+            continue
+        if batch and (len(batch) >= limits.count or batch_size + size > limits.size):
+            yield batch
+            batch = []
+            batch_size = 0
+        batch.append(item)
+        batch_size += size
+    if batch:
+        yield batch
+
+
+def retry_failed(send, items: list, deadline: float, attempts: int = 5, base: float = 0.1, cap: float = 5.0) -> list:
+    """
+    Sends the items with send, which returns the items that failed, and resends only those
+    with full jitter exponential backoff until they all succeed, attempts run out or the next
+    wait would cross the deadline. Returns the items that still failed
+    """
+    failed = send(items)
+    for attempt in range(1, attempts):
+        if not failed:
+            break
+        delay = random.uniform(0, min(cap, base * 2 ** attempt))
+        if time.monotonic() + delay > deadline:
+            break
+        time.sleep(delay)
+        failed = send(failed)
+    return failed
+
+
+def get_deadline(context, reserve: float = 10.0) -> float:
+    """
+    Returns the time.monotonic() value by which retries should stop, leaving reserve seconds to the invocation
+    """
+    return time.monotonic() + context.get_remaining_time_in_millis() / 1000 - reserve
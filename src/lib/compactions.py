@@ -0,0 +1,259 @@
+"""
+Compaction generations of the simlinked partitions, kept in the compacted partitions table next to the
+compaction transactions: the compacted outputs the symlink manifest of a partition references, and the
+cutoff of the firehose objects they contain, so that a reopened partition only compacts the later objects.
+The same item holds the compaction pending after a close, and the lease of the compaction running
+"""
+import os
+import json
+import logging
+from datetime import datetime, timedelta
+
+import backoff
+import boto3
+import botocore
+
+from boto3.dynamodb.conditions import Attr
+
+from lib.partitions import read_all
+
+# pylint: disable=invalid-name, line-too-long, logging-fstring-interpolation
+
+log = logging.getLogger()
+dynamodb = boto3.resource('dynamodb')
+COMPACTED_PARTITIONS = os.environ.get('COMPACTED_PARTITIONS')
+# sparse index of the pending compactions, keyed on attributes only set until the compaction starts
+PENDING_INDEX = 'pending-index'
+# a partition is not compacted again until its running compaction is linked, or this lease expires if it failed
+COMPACTION_LEASE_SECONDS = int(os.environ.get('COMPACTION_LEASE_SECONDS', '3600'))
+# a compaction whose query failed is scheduled again after this delay, until it failed this many times
+COMPACTION_RETRY_SECONDS = int(os.environ.get('COMPACTION_RETRY_SECONDS', '900'))
+MAX_COMPACTION_FAILURES = int(os.environ.get('MAX_COMPACTION_FAILURES', '3'))
+
+@backoff.on_exception(backoff.expo, botocore.exceptions.ClientError, max_time=10)
+def get_generations(location: str) -> dict:
+    """
+    Returns the compaction state of the partition with the given symlink location, empty if it was never compacted
+    """
+    return dynamodb.Table(COMPACTED_PARTITIONS).get_item(
+        Key={
+            'tmptable': location
+        },
+        ConsistentRead=True
+    ).get('Item') or {}
+
+def get_cutoff(objects: list):
+    """
+    Returns the (iso cutoff, keys at the cutoff) of the latest listed objects.
+    LastModified has a second precision, the keys tell the objects of the cutoff second already compacted
+    """
+    if not objects:
+        return None, []
+    cutoff = max(obj['LastModified'].isoformat() for obj in objects)
+    return cutoff, [obj['Key'] for obj in objects if obj['LastModified'].isoformat() == cutoff]
+
+def get_later_objects(objects: list, generations: dict) -> list:
+    """
+    Returns the listed objects that are not in the compacted generations yet
+    """
+    cutoff = generations.get('cutoff') or ''
+    cutoff_keys = set(generations.get('cutoff_keys') or [])
+    return [
+        obj for obj in objects
+        if obj['LastModified'].isoformat() > cutoff or (obj['LastModified'].isoformat() == cutoff and obj['Key'] not in cutoff_keys)
+    ]
+
+@backoff.on_exception(backoff.expo, botocore.exceptions.ClientError, max_time=10)
+def schedule_compaction(location: str, record: dict, due: str):
+    """
+    Record the compaction of a closed partition, due at the end of its grace period.
+    Closing the partition again before then postpones it with the latest record
+    """
+    return dynamodb.Table(COMPACTED_PARTITIONS).update_item(
+        Key={
+            'tmptable': location
+        },
+        UpdateExpression='SET #pending = :pending, #pending_table = :pending_table, #due = :due',
+        ExpressionAttributeNames={
+            '#pending': 'pending',
+            '#pending_table': 'pending_table',
+            '#due': 'due'
+        },
+        ExpressionAttributeValues={
+            # the record is kept as json, it's only read back as is
+            ':pending': json.dumps(record),
+            ':pending_table': record['db_table'],
+            ':due': due
+        },
+        ReturnValues='ALL_NEW'
+    ).get('Attributes')
+
+@backoff.on_exception(backoff.expo, botocore.exceptions.ClientError, max_time=10)
+def cancel_compaction(location: str) -> bool:
+    """
+    Drop the pending compaction of a reopened partition, its next close schedules it again.
+    Returns True if a compaction was pending
+    """
+    try:
+        dynamodb.Table(COMPACTED_PARTITIONS).update_item(
+            Key={
+                'tmptable': location
+            },
+            UpdateExpression='REMOVE #pending, #pending_table, #due',
+            ConditionExpression='attribute_exists(#due)',
+            ExpressionAttributeNames={
+                '#pending': 'pending',
+                '#pending_table': 'pending_table',
+                '#due': 'due'
+            }
+        )
+        log.info(f'pending compaction of {location} cancelled')
+        return True
+    except dynamodb.meta.client.exceptions.ConditionalCheckFailedException:
+        return False
+
+@backoff.on_exception(backoff.expo, botocore.exceptions.ClientError, max_time=10)
+def get_due_compactions(now: str) -> list:
+    """
+    Returns the pending compactions due by now, the index being sparse the scan reads the pending ones only
+    """
+    return read_all(
+        dynamodb.Table(COMPACTED_PARTITIONS).scan,
+        IndexName=PENDING_INDEX,
+        FilterExpression=Attr('due').lte(now)
+    )
+
+@backoff.on_exception(backoff.expo, botocore.exceptions.ClientError, max_time=10)
+def claim_compaction(item: dict, now: datetime):
+    """
+    Take the lease of a pending compaction, unless it was postponed or cancelled meanwhile, or the previous
+    compaction of the partition is still running, in which case it stays pending. Returns the pending record, or None
+    """
+    try:
+        dynamodb.Table(COMPACTED_PARTITIONS).update_item(
+            Key={
+                'tmptable': item['tmptable']
+            },
+            # the owner of an expired lease can't release this one
+            UpdateExpression='SET #running_until = :running_until REMOVE #pending, #pending_table, #due, #running',
+            ConditionExpression='#due = :due AND (attribute_not_exists(#running_until) OR #running_until < :now)',
+            ExpressionAttributeNames={
+                '#pending': 'pending',
+                '#pending_table': 'pending_table',
+                '#due': 'due',
+                '#running_until': 'running_until',
+                '#running': 'running'
+            },
+            ExpressionAttributeValues={
+                ':due': item['due'],
+                ':now': now.isoformat(),
+                ':running_until': (now + timedelta(seconds=COMPACTION_LEASE_SECONDS)).isoformat()
+            }
+        )
+        return json.loads(item['pending'])
+    except dynamodb.meta.client.exceptions.ConditionalCheckFailedException:
+        log.info(f'compaction of {item["tmptable"]} postponed, cancelled or still running')
+        return None
+
+@backoff.on_exception(backoff.expo, botocore.exceptions.ClientError, max_time=10)
+def own_compaction(location: str, tmptable: str):
+    """
+    Record the tmp table of the query compacting a claimed partition as the owner of its lease
+    """
+    try:
+        return dynamodb.Table(COMPACTED_PARTITIONS).update_item(
+            Key={
+                'tmptable': location
+            },
+            UpdateExpression='SET #running = :running',
+            ConditionExpression='attribute_exists(#running_until)',
+            ExpressionAttributeNames={'#running': 'running', '#running_until': 'running_until'},
+            ExpressionAttributeValues={':running': tmptable}
+        )
+    except dynamodb.meta.client.exceptions.ConditionalCheckFailedException:
+        log.warning(f'compaction lease of {location} lost before {tmptable} started')
+        return None
+
+@backoff.on_exception(backoff.expo, botocore.exceptions.ClientError, max_time=10)
+def release_compaction(location: str, tmptable: str = None) -> bool:
+    """
+    Release the lease of a compaction that ended, only if the query writing tmptable still owns it when given.
+    Returns False if the lease belongs to another compaction
+    """
+    kwargs: dict = {
+        'Key': {
+            'tmptable': location
+        },
+        'UpdateExpression': 'REMOVE #running_until, #running',
+        'ExpressionAttributeNames': {'#running_until': 'running_until', '#running': 'running'}
+    }
+    if tmptable:
+        kwargs['ConditionExpression'] = '#running = :running'
+        kwargs['ExpressionAttributeValues'] = {':running': tmptable}
+    try:
+        dynamodb.Table(COMPACTED_PARTITIONS).update_item(**kwargs)
+        return True
+    except dynamodb.meta.client.exceptions.ConditionalCheckFailedException:
+        log.info(f'compaction lease of {location} not owned by {tmptable}')
+        return False
+
+@backoff.on_exception(backoff.expo, botocore.exceptions.ClientError, max_time=10)
+def retry_compactions(tmptable: str, now: datetime) -> list:
+    """
+    Release the leases the failed query writing tmptable holds on its partitions, and schedule their compaction again
+    unless a later close already did, or it failed MAX_COMPACTION_FAILURES times. Returns the locations scheduled again
+    """
+    item = dynamodb.Table(COMPACTED_PARTITIONS).get_item(
+        Key={
+            'tmptable': tmptable
+        }
+    ).get('Item') or {}
+    scheduled: list = []
+    for partition in item.get('partitions') or []:
+        if 'pending' not in partition:
+            release_compaction(partition['location'], tmptable)
+            continue
+        record = json.loads(partition['pending'])
+        record['failures'] = int(record.get('failures', 0)) + 1
+        if record['failures'] >= MAX_COMPACTION_FAILURES:
+            if release_compaction(partition['location'], tmptable):
+                log.error({
+                    'Code': 500,
+                    'Message': f'compaction of {partition["location"]} failed {record["failures"]} times, not scheduled again'
+                })
+        elif reschedule_compaction(partition['location'], tmptable, record, (now + timedelta(seconds=COMPACTION_RETRY_SECONDS)).isoformat()):
+            scheduled.append(partition['location'])
+        else:
+            release_compaction(partition['location'], tmptable)
+    return scheduled
+
+def reschedule_compaction(location: str, tmptable: str, record: dict, due: str) -> bool:
+    """
+    Release the lease of the query writing tmptable and make its compaction pending again in a single update,
+    if that query still owns the lease and the partition wasn't closed again meanwhile. Returns False otherwise
+    """
+    try:
+        dynamodb.Table(COMPACTED_PARTITIONS).update_item(
+            Key={
+                'tmptable': location
+            },
+            UpdateExpression='SET #pending = :pending, #pending_table = :pending_table, #due = :due REMOVE #running_until, #running',
+            ConditionExpression='#running = :running AND attribute_not_exists(#due)',
+            ExpressionAttributeNames={
+                '#pending': 'pending',
+                '#pending_table': 'pending_table',
+                '#due': 'due',
+                '#running_until': 'running_until',
+                '#running': 'running'
+            },
+            ExpressionAttributeValues={
+                ':pending': json.dumps(record),
+                ':pending_table': record['db_table'],
+                ':due': due,
+                ':running': tmptable
+            }
+        )
+        log.info(f'compaction of {location} failed, scheduled again at {due}')
+        return True
+    except dynamodb.meta.client.exceptions.ConditionalCheckFailedException:
+        return False
@@ -13,6 +13,10 @@ from lib.records import KinesisRecord, DynamoRecord
 log = logging.getLogger()
 
 def kinesis_handler(event_types, batch_size=1):
+    """
+    Calls the decorated handler with the deaggregated records matching any of the event types,
+    in chunks of batch_size records, or with all of them at once if batch_size is None
+    """
     def handler_decorator(func):
         @wraps(func)
         def lambda_handler(*args, **kwargs):
@@ -44,6 +48,10 @@ def kinesis_handler(event_types, batch_size=1):
     return handler_decorator
 
 def dynamo_handler(event_types, batch_size=1):
+    """
+    Calls the decorated handler with the records matching any of the event types,
+    in chunks of batch_size records, or with all of them at once if batch_size is None
+    """
     def handler_decorator(func):
         @wraps(func)
         def lambda_handler(*args, **kwargs):
@@ -76,8 +84,11 @@ def dynamo_handler(event_types, batch_size=1):
 
 def chunks(iterable, size):
     """
-    Chunks an iterable in a sequence of iterables with the given size 
+    Chunks an iterable in a sequence of iterables with the given size, or in a single one if size is None
     """
+    if size is None:
+        yield iterable
+        return
     iterator = iter(iterable)
     for first in iterator:
         yield chain([first], islice(iterator, size - 1))
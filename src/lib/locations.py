@@ -0,0 +1,116 @@
+"""
+In memory index of the Glue tables locations mapped in dynamodb, answering longest prefix lookups
+"""
+import logging
+import time
+from datetime import datetime, timedelta
+
+import backoff
+import botocore
+from boto3.dynamodb.conditions import Attr
+from cachetools import TTLCache
+
+from lib.partitions import read_all
+
+# pylint: disable=invalid-name, line-too-long, logging-fstring-interpolation
+
+log = logging.getLogger()
+ITEM = None  # trie node key holding the item mapped at that location
+
+class LocationsIndex:
+    """
+    Prefix trie of the tables locator items, keyed by the segments of their location.
+    Items pointing to a symlinked table are merged with the symlinked table item when loaded.
+    The locator table is fully scanned on first use and every full_refresh seconds. In between,
+    a lookup that misses loads only the items updated since the previous scan, at most every refresh seconds.
+    Misses are cached for miss_ttl seconds, so that objects outside of any table cost no calls either
+    """
+    def __init__(self, dynamo_table, refresh: float = 60, full_refresh: float = 3600, miss_ttl: float = 300):
+        self.dynamo_table = dynamo_table
+        self.refresh = refresh
+        self.full_refresh = full_refresh
+        self._items: dict = {}
+        self._trie: dict = {}
+        self._misses = TTLCache(maxsize=10000, ttl=miss_ttl)
+        self._scanned = None  # utc time of the last scan start
+        self._refreshed = 0.0  # monotonic time of the last scan
+        self._full_refreshed = 0.0  # monotonic time of the last full scan
+
+    def lookup(self, bucket: str, prefix: str):
+        """
+        Returns the item of the table with the longest location matching s3://bucket/prefix, or None
+        """
+        now = time.monotonic()
+        if not self._full_refreshed or now - self._full_refreshed > self.full_refresh:
+            self.load(full=True)
+        item = self.match(bucket, prefix)
+        if item or (bucket, prefix) in self._misses:
+            return item
+        if now - self._refreshed > self.refresh and self.load(full=False):
+            item = self.match(bucket, prefix)
+        if not item:
+            self._misses[(bucket, prefix)] = True
+        return item
+
+    def match(self, bucket: str, prefix: str):
+        """
+        Walks the trie down the prefix segments, returning the deepest item found below the bucket
+        """
+        node = self._trie.get(bucket)
+        item = None
+        if node is None:
+            return None
+        for segment in prefix.split('/'):
+            node = node.get(segment)
+            if node is None:
+                break
+            item = node.get(ITEM, item)
+        return item
+
+    def load(self, full: bool) -> int:
+        """
+        Loads the items of the locator table, or only the ones updated since the last scan,
+        and rebuilds the trie if anything changed. Returns the number of items loaded
+        """
+        started = datetime.utcnow()
+        if full or not self._scanned:
+            items = self.scan()
+            self._items = {}
+            self._full_refreshed = time.monotonic()
+        else:
+            # allow for some clock skew between the writers and this container
+            items = self.scan(FilterExpression=Attr('updated').gt((self._scanned - timedelta(seconds=60)).isoformat()))
+        self._scanned = started
+        self._refreshed = time.monotonic()
+        for item in items:
+            self._items[item['location']] = item
+        if items or full:
+            self.build()
+            self._misses.clear()
+        log.info(f'loaded {len(items)} table locations, {len(self._items)} mapped')
+        return len(items)
+
+    @backoff.on_exception(backoff.expo, botocore.exceptions.ClientError, max_time=10)
+    def scan(self, **kwargs) -> list:
+        """
+        Scans all the pages of the locator table
+        """
+        return read_all(self.dynamo_table.scan, **kwargs)
+
+    def build(self):
+        """
+        Rebuilds the trie from the loaded items, merging symlink items with the table they link to
+        """
+        trie: dict = {}
+        for location, item in self._items.items():
+            symlink = item.get('symlink')
+            if symlink:
+                symlinked = self._items.get(symlink)
+                if symlinked:
+                    item = dict(symlinked)
+                    item.update(self._items[location])
+            node = trie
+            for segment in location.split('://', 1)[-1].rstrip('/').split('/'):
+                node = node.setdefault(segment, {})
+            node[ITEM] = item
+        self._trie = trie
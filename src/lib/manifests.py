@@ -0,0 +1,175 @@
+"""
+Symlink manifests of the simlinked partitions, listing the compacted outputs and the firehose objects not compacted yet
+rather than a prefix, so that Athena doesn't list the partition at query time. The lists are kept in the compaction state
+of the partition, every change bumping its manifest version, and the manifest is always rendered from the state
+"""
+import os
+import logging
+
+import backoff
+import botocore
+
+from lib.compactions import dynamodb, COMPACTED_PARTITIONS, get_generations, get_later_objects, release_compaction
+from lib.s3 import upload_file, list_objects, get_object_location
+
+# pylint: disable=invalid-name, line-too-long, logging-fstring-interpolation
+
+log = logging.getLogger()
+MANIFEST_VERSION = 'manifest_version'
+# past this many objects not compacted yet, the manifest lists the firehose prefix instead, keeping the state well below the item size limit
+MAX_MANIFEST_OBJECTS = int(os.environ.get('MAX_MANIFEST_OBJECTS', '1000'))
+
+@backoff.on_exception(backoff.expo, botocore.exceptions.ClientError, max_time=10)
+def append_objects(location: str, source: str, paths: list):
+    """
+    Add the objects landed at the firehose source of a partition to its manifest. The objects are added to a set,
+    so that objects seen twice are listed once, and partitions not tracked yet are listed from their source
+    """
+    try:
+        item = dynamodb.Table(COMPACTED_PARTITIONS).update_item(
+            Key={
+                'tmptable': location
+            },
+            UpdateExpression='SET #source = :source ADD #objects :paths, #version :one',
+            ConditionExpression='attribute_exists(#version) AND attribute_not_exists(#listed)',
+            ExpressionAttributeNames={
+                '#source': 'source',
+                '#objects': 'objects',
+                '#version': MANIFEST_VERSION,
+                '#listed': 'listed'
+            },
+            ExpressionAttributeValues={
+                ':source': source,
+                ':paths': set(paths),
+                ':one': 1
+            },
+            ReturnValues='ALL_NEW'
+        ).get('Attributes')
+    except dynamodb.meta.client.exceptions.ConditionalCheckFailedException:
+        if get_generations(location).get('listed'):
+            # the manifest already lists the whole prefix
+            return None
+        return refresh_objects(location, source)
+    if len(item.get('objects', [])) > MAX_MANIFEST_OBJECTS:
+        return refresh_objects(location, source)
+    return publish_manifest(location)
+
+def refresh_objects(location: str, source: str, attempts: int = 3):
+    """
+    List the objects of the partition source not compacted yet, and replace the objects of its manifest with them
+    """
+    for _ in range(attempts):
+        item = get_generations(location)
+        if put_manifest(location, item, source, get_later_paths(source, item)):
+            return publish_manifest(location)
+    log.warning(f'{location} changed concurrently, not refreshed')
+    return None
+
+def swap_generations(location: str, tmptable: str, source: str, outputs: list, cutoff: str, cutoff_keys: list, previous_cutoff: str = None, attempts: int = 3):
+    """
+    Atomically replace the manifest of a partition with the outputs of the compaction writing tmptable, followed by the objects
+    past its cutoff, then release the compaction lease if tmptable still owns it. Nothing is linked if tmptable was linked
+    already, or if another compaction of the partition was linked since previous_cutoff
+    """
+    for _ in range(attempts):
+        item = get_generations(location)
+        if item.get('linked') == tmptable:
+            log.info(f'{tmptable} already linked to {location}')
+            return None
+        if item.get('cutoff') not in (previous_cutoff, cutoff):
+            log.warning(f'another compaction of {location} was linked since {previous_cutoff}')
+            release_compaction(location, tmptable)
+            return None
+        source = source or item.get('source')
+        # objects landing after the listing bump the version, and the swap is attempted again
+        paths = get_later_paths(source, {'cutoff': cutoff, 'cutoff_keys': cutoff_keys}) if source else None
+        if put_manifest(location, item, source, paths, outputs=outputs, cutoff=cutoff, cutoff_keys=cutoff_keys, linked=tmptable):
+            release_compaction(location, tmptable)
+            return publish_manifest(location)
+    log.warning(f'{location} changed concurrently, not linked')
+    release_compaction(location, tmptable)
+    return None
+
+def get_later_paths(source: str, generations: dict) -> list:
+    """
+    Returns the locations of the objects at source that are not in the compacted generations yet
+    """
+    return [get_object_location(source, obj['Key']) for obj in get_later_objects(list_objects(source), generations)]
+
+@backoff.on_exception(backoff.expo, botocore.exceptions.ClientError, max_time=10)
+def put_manifest(location: str, item: dict, source: str, paths: list = None, **attributes) -> bool:
+    """
+    Conditionally set the objects and attributes of a manifest, if it is still at the version of the item read.
+    Objects aren't changed when paths is None. Returns False on conflict
+    """
+    version = item.get(MANIFEST_VERSION)
+    names = {
+        '#version': MANIFEST_VERSION
+    }
+    values = {
+        ':next_version': (version or 0) + 1
+    }
+    if source:
+        attributes['source'] = source
+    sets = ['#version = :next_version']
+    removes: list = []
+    for name, value in attributes.items():
+        names[f'#{name}'] = name
+        values[f':{name}'] = value
+        sets.append(f'#{name} = :{name}')
+    if paths is not None:
+        names['#objects'] = 'objects'
+        names['#listed'] = 'listed'
+        if len(paths) > MAX_MANIFEST_OBJECTS:
+            sets.append('#listed = :listed')
+            values[':listed'] = True
+            removes.append('#objects')
+        elif paths:
+            sets.append('#objects = :objects')
+            values[':objects'] = set(paths)
+            removes.append('#listed')
+        else:
+            # dynamodb sets can't be empty
+            removes.extend(['#objects', '#listed'])
+    if version is None:
+        condition = 'attribute_not_exists(#version)'
+    else:
+        condition = '#version = :version'
+        values[':version'] = version
+    try:
+        dynamodb.Table(COMPACTED_PARTITIONS).update_item(
+            Key={
+                'tmptable': location
+            },
+            UpdateExpression='SET ' + ', '.join(sets) + (' REMOVE ' + ', '.join(removes) if removes else ''),
+            ConditionExpression=condition,
+            ExpressionAttributeNames=names,
+            ExpressionAttributeValues=values
+        )
+        return True
+    except dynamodb.meta.client.exceptions.ConditionalCheckFailedException:
+        return False
+
+def publish_manifest(location: str, source: str = None, attempts: int = 3):
+    """
+    Write the manifest of a partition from its state, again if the state changed meanwhile, so that a slower writer
+    can't leave an older list. A partition not tracked yet is listed from its source first. Returns the version written
+    """
+    for _ in range(attempts):
+        item = get_generations(location)
+        if MANIFEST_VERSION not in item:
+            return refresh_objects(location, source) if source else None
+        lines = render_manifest(item)
+        upload_file(location, '\n'.join(lines))
+        if get_generations(location).get(MANIFEST_VERSION) == item[MANIFEST_VERSION]:
+            return f'{location} version {item[MANIFEST_VERSION]}, {len(lines)} paths'
+    return None
+
+def render_manifest(item: dict) -> list:
+    """
+    Returns the lines of a manifest: the compacted outputs then the objects not compacted yet,
+    or the whole firehose prefix when there are too many objects to list
+    """
+    if item.get('listed'):
+        return [item['source'].rstrip('/') + '/']
+    return list(item.get('outputs') or []) + sorted(item.get('objects') or [])
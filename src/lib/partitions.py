@@ -0,0 +1,127 @@
+"""
+States of the partitions mapped in dynamodb, and their conditional transitions
+"""
+import logging
+
+# pylint: disable=invalid-name, line-too-long, logging-fstring-interpolation
+
+log = logging.getLogger()
+OPENED = "opened"
+CLOSED = "closed"
+# sparse index of the open partitions, keyed on an attribute only set while the partition is opened
+OPEN_INDEX = 'open-index'
+OPEN_LOCATOR = 'open_locator'
+
+def query_all(dynamo_table, **kwargs) -> list:
+    """
+    Queries all the pages of the partitions table
+    """
+    return read_all(dynamo_table.query, **kwargs)
+
+def scan_all(dynamo_table, **kwargs) -> list:
+    """
+    Scans all the pages of the partitions table, or of one of its indexes
+    """
+    return read_all(dynamo_table.scan, **kwargs)
+
+def read_all(read, limit: int = None, **kwargs) -> list:
+    """
+    Calls a paginated read until its last page, or until it read limit items, returning at most limit of them
+    """
+    items: list = []
+    while True:
+        response = read(**kwargs)
+        items.extend(response.get('Items', []))
+        last_key = response.get('LastEvaluatedKey')
+        if not last_key or (limit and len(items) >= limit):
+            return items[:limit] if limit else items
+        kwargs['ExclusiveStartKey'] = last_key
+
+def get_last_activity(partition_entry: dict) -> str:
+    """
+    Returns the iso timestamp of the latest transition or object seen in the partition
+    """
+    return max(partition_entry.get('updated', ''), partition_entry.get('touched', ''))
+
+def transition(dynamo_table, partition_entry: dict, from_state: str, to_state: str, timestamp: str, compact: bool = False, idle_since: str = None):
+    """
+    Conditionally update the state of a partition entry, checking its state and version (entries written
+    before versioning are matched by the missing attribute). With idle_since, the entry must also have seen
+    no object since then. Returns the updated entry, or None on conflict
+    """
+    version = partition_entry.get('version', 0)
+    update = 'SET #state = :to_state, #updated = :updated, #version = :next_version'
+    condition = '#state = :from_state AND (attribute_not_exists(#version) OR #version = :version)'
+    names = {
+        '#state': 'state',
+        '#updated': 'updated',
+        '#version': 'version',
+        '#open_locator': OPEN_LOCATOR
+    }
+    values = {
+        ':from_state': from_state,
+        ':to_state': to_state,
+        ':updated': timestamp,
+        ':version': version,
+        ':next_version': version + 1
+    }
+    if to_state == OPENED:
+        update += ', #touched = :updated, #open_locator = :locator'
+        names['#touched'] = 'touched'
+        values[':locator'] = partition_entry['locator']
+    else:
+        # closed partitions drop out of the sparse open index
+        update += ' REMOVE #open_locator'
+    if idle_since:
+        condition += ' AND (attribute_not_exists(#touched) OR #touched < :idle_since)'
+        names['#touched'] = 'touched'
+        values[':idle_since'] = idle_since
+    if compact:
+        # atomic increment, so that a lost update can't start the same generation twice
+        update += ' ADD #compacted :one'
+        names['#compacted'] = 'compacted'
+        values[':one'] = 1
+    try:
+        return dynamo_table.update_item(
+            Key={
+                'locator': partition_entry['locator'],
+                'partition': partition_entry['partition']
+            },
+            UpdateExpression=update,
+            ConditionExpression=condition,
+            ExpressionAttributeNames=names,
+            ExpressionAttributeValues=values,
+            ReturnValues='ALL_NEW'
+        ).get('Attributes')
+    except dynamo_table.meta.client.exceptions.ConditionalCheckFailedException:
+        log.info(f'partition {partition_entry["locator"]}, {partition_entry["partition"]} changed concurrently, not {to_state}')
+        return None
+
+def touch(dynamo_table, partition_entry: dict, timestamp: str):
+    """
+    Records that an object landed in an open partition, without changing its state nor version,
+    so that the stream publisher knows not to dispatch this change
+    """
+    try:
+        return dynamo_table.update_item(
+            Key={
+                'locator': partition_entry['locator'],
+                'partition': partition_entry['partition']
+            },
+            UpdateExpression='SET #touched = :touched',
+            ConditionExpression='#state = :opened',
+            ExpressionAttributeNames={'#touched': 'touched', '#state': 'state'},
+            ExpressionAttributeValues={':touched': timestamp, ':opened': OPENED},
+            ReturnValues='ALL_NEW'
+        ).get('Attributes')
+    except dynamo_table.meta.client.exceptions.ConditionalCheckFailedException:
+        return None
+
+def is_touch(old_item: dict, new_item: dict) -> bool:
+    """
+    Returns True if the partition item change only recorded objects landing in it: the stream images
+    have the same state and version, which every transition changes. New items are never a touch
+    """
+    if not old_item:
+        return False
+    return old_item.get('state') == new_item.get('state') and old_item.get('version') == new_item.get('version')
@@ -0,0 +1,176 @@
+"""
+KPL compatible producer, aggregating records for the firehoses into the DataStream
+"""
+import json
+import logging
+import threading
+import time
+
+import backoff
+import boto3
+import botocore
+from aws_kinesis_agg.aggregator import RecordAggregator
+
+from lib.batches import pack, retry_failed, KINESIS_LIMITS
+
+# pylint: disable=invalid-name, line-too-long
+
+log = logging.getLogger()
+
+class Producer:
+    """
+    Aggregates (table, payload) records in KPL aggregated records and publishes them to a Kinesis stream.
+    Every user record is keyed by the ARN of the table firehose, so that consumers deaggregating the stream
+    route it through KinesisRecord.FIREHOSE_TARGET_EVENT.
+    Pending records are flushed when they fill a PutRecords request, when the oldest one is older than
+    max_delay seconds (if the background flusher is started) or on demand with flush().
+    """
+    def __init__(self, stream_name: str, region: str = None, account: str = None, max_delay: float = 1.0, max_retry_time: float = 30.0, kinesis=None):
+        self.stream_name = stream_name
+        self.kinesis = kinesis or boto3.client('kinesis', region_name=region)
+        self.region = region or self.kinesis.meta.region_name
+        self.account = account if account is not None else boto3.client('sts').get_caller_identity()['Account']
+        self.max_delay = max_delay
+        self.max_retry_time = max_retry_time
+        self._aggregator = RecordAggregator()
+        self._completed: list = []
+        self._completed_size = 0
+        self._oldest = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.close()
+
+    def get_partition_key(self, table: str) -> str:
+        """
+        Returns the firehose ARN routing records to the given database.table
+        """
+        return f'arn:aws:firehose:{self.region}:{self.account}:deliverystream/{table}'
+
+    def put(self, table: str, payload):
+        """
+        Adds a record for the given database.table, dict payloads are serialized as json
+        """
+        if isinstance(payload, dict):
+            payload = json.dumps(payload)
+        with self._lock:
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+            completed = self._aggregator.add_user_record(self.get_partition_key(table), payload)
+            if completed:
+                self._completed.append(to_entry(completed))
+                self._completed_size += sizeof(self._completed[-1])
+            full = len(self._completed) >= KINESIS_LIMITS.count or self._completed_size + self._aggregator.get_size_bytes() >= KINESIS_LIMITS.size
+        if full:
+            self.flush()
+
+    def flush(self) -> list:
+        """
+        Publishes all the pending records, returns the PutRecords entries that could not be published
+        """
+        with self._flush_lock:
+            with self._lock:
+                entries = self._completed
+                last = self._aggregator.clear_and_get()
+                if last:
+                    entries.append(to_entry(last))
+                self._completed = []
+                self._completed_size = 0
+                self._oldest = None
+            deadline = time.monotonic() + self.max_retry_time
+            failed = [
+                entry
+                for batch in pack(entries, KINESIS_LIMITS, sizeof=sizeof)
+                for entry in retry_failed(self.put_records, batch, deadline)
+            ]
+        if failed:
+            log.error({
+                'Code': 500,
+                'Message': f'{len(failed)} aggregated records could not be published to {self.stream_name}'
+            })
+        return failed
+
+    def start(self):
+        """
+        Starts the background thread flushing records older than max_delay
+        """
+        if not self._thread:
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        return self
+
+    def close(self) -> list:
+        """
+        Stops the background thread and flushes the pending records
+        """
+        if self._thread:
+            self._stopped.set()
+            self._thread.join()
+            self._thread = None
+        return self.flush()
+
+    def _run(self):
+        while not self._stopped.wait(self.max_delay / 2):
+            oldest = self._oldest
+            if oldest is not None and time.monotonic() - oldest >= self.max_delay:
+                self.flush()
+
+    @backoff.on_exception(backoff.expo, botocore.exceptions.ClientError, max_time=10)
+    def put_records(self, entries: list) -> list:
+        """
+        Sends a batch of PutRecords entries, returns the ones that failed
+        """
+        result = self.kinesis.put_records(
+            StreamName=self.stream_name,
+            Records=entries
+        )
+        if result.get('FailedRecordCount'):
+            return [
+                entries[i] for i, response in enumerate(result['Records'])
+                if "ErrorCode" in response
+            ]
+        return []
+
+def aggregate(records) -> list:
+    """
+    Aggregates (partition_key, payload) records in PutRecords entries, each holding the records of a single
+    partition key in their original order, so that the records of a key all land on the shard of that key
+    """
+    aggregators: dict = {}
+    entries: list = []
+    for partition_key, payload in records:
+        aggregator = aggregators.setdefault(partition_key, RecordAggregator())
+        completed = aggregator.add_user_record(partition_key, payload)
+        if completed:
+            entries.append(to_entry(completed))
+    for aggregator in aggregators.values():
+        last = aggregator.clear_and_get()
+        if last:
+            entries.append(to_entry(last))
+    return entries
+
+def to_entry(agg_record) -> dict:
+    """
+    Converts an aggregated record in a PutRecords entry
+    """
+    partition_key, explicit_hash_key, data = agg_record.get_contents()
+    entry = {
+        'Data': data,
+        'PartitionKey': partition_key
+    }
+    if explicit_hash_key:
+        entry['ExplicitHashKey'] = explicit_hash_key
+    return entry
+
+def sizeof(entry: dict) -> int:
+    """
+    Returns the size of a PutRecords entry as accounted by Kinesis
+    """
+    return len(entry['Data']) + len(entry['PartitionKey'])
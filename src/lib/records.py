@@ -18,6 +18,7 @@ class KinesisRecord(Mapping):
     GLUE_SOURCE_EVENT = re.compile(r'(aws.glue):?(.*)')
     S3_SOURCE_EVENT = re.compile(r'(aws.s3):?(.*)')
     FIREHOSE_SOURCE_EVENT = re.compile(r'(aws.firehose):?(.*)')
+    ATHENA_SOURCE_EVENT = re.compile(r'(aws.athena):?(.*)')
     FIREHOSE_TARGET_EVENT = re.compile(r'arn:aws:firehose:([^:]*):(\d*):deliverystream/([^:]+)(:.*)?')
     OPENED_PARTITION_EVENT = re.compile(r'(custom.event.partition.opened):?(.*)')
     CLOSED_PARTITION_EVENT = re.compile(r'(custom.event.partition.closed):?(.*)')
@@ -61,4 +61,33 @@ def check_prefix(location):
             'Prefix': prefix if prefix[-1:]=='/' else prefix + '/'
         }
         return s3.list_objects_v2(**kwargs).get('Contents') is not None
-    return False
\ No newline at end of file
+    return False
+
+@backoff.on_exception(backoff.expo, botocore.exceptions.ClientError, max_time=10)
+def list_objects(location: str) -> list:
+    """
+    Returns the listed objects (Key, Size, LastModified...) at the given prefix, ensuring that '/' is appended to it if not present
+    """
+    objects: list = []
+    match = re.match(S3_LOCATION_REGEX, location)
+    if match:
+        prefix = match[2]
+        kwargs = {
+            'Bucket': match[1],
+            'Prefix': prefix if prefix[-1:]=='/' else prefix + '/'
+        }
+        while True:
+            response = s3.list_objects_v2(**kwargs)
+            objects.extend(response.get('Contents', []))
+            token = response.get('NextContinuationToken')
+            if not token:
+                break
+            kwargs['ContinuationToken'] = token
+    return objects
+
+def get_object_location(location: str, key: str) -> str:
+    """
+    Returns the s3 location of a key listed in the bucket of the given location
+    """
+    match = re.match(S3_LOCATION_REGEX, location)
+    return f's3://{match[1]}/{key}' if match else None
@@ -0,0 +1,96 @@
+"""
+Projects json records on the columns of a Glue table, coercing simple values to the declared types
+"""
+import re
+import math
+from datetime import datetime
+
+# pylint: disable=invalid-name, line-too-long
+
+INTEGER_TYPES = ('tinyint', 'smallint', 'int', 'integer', 'bigint')
+# decimal values are left as they are, as floats they would lose precision
+FLOAT_TYPES = ('float', 'double')
+STRING_TYPES = ('string', 'varchar', 'char')
+INTEGER = re.compile(r'^\s*[-+]?\d+\s*$')
+# epoch values above this are taken as milliseconds, as seconds they would be past the year 5000
+EPOCH_MILLIS_THRESHOLD = 100000000000
+
+
+def get_columns(table) -> dict:
+    """
+    Returns the declared columns of a GlueTable, as a map from the name the json serde matches to the column type.
+    The serde is case insensitive and converts dots in keys to underscores, and so are the names
+    """
+    return {
+        column['Name'].lower(): column['Type'].lower() for column in table.get_storage_descriptor().get('Columns', [])
+    }
+
+
+def project(data: dict, columns: dict) -> dict:
+    """
+    Returns a record with only the members of data matching a declared column, with their values coerced
+    """
+    projected: dict = {}
+    for key, value in data.items():
+        column_type = columns.get(key.lower().replace('.', '_'))
+        if column_type:
+            projected[key] = coerce(value, column_type)
+    return projected
+
+
+def coerce(value, column_type: str):
+    """
+    Coerces a scalar value to the given column type, returns the value unchanged when it doesn't apply.
+    Non finite numbers are dropped, as json has no representation for them
+    """
+    if value is None or isinstance(value, (dict, list)):
+        return value
+    if isinstance(value, float) and not math.isfinite(value):
+        return None
+    base_type = column_type.split('(', 1)[0]
+    try:
+        if base_type in INTEGER_TYPES:
+            if isinstance(value, bool):
+                return int(value)
+            if isinstance(value, str) and INTEGER.match(value):
+                return int(value)
+            if isinstance(value, float) and value.is_integer():
+                return int(value)
+        elif base_type in FLOAT_TYPES:
+            if isinstance(value, bool):
+                return float(value)
+            if isinstance(value, str):
+                number = float(value)
+                return number if math.isfinite(number) else None
+        elif base_type == 'boolean':
+            if isinstance(value, str) and value.lower() in ('true', 'false'):
+                return value.lower() == 'true'
+        elif base_type in STRING_TYPES:
+            if not isinstance(value, str):
+                return str(value).lower() if isinstance(value, bool) else str(value)
+        elif base_type == 'timestamp':
+            epoch = to_epoch(value)
+            if epoch is not None:
+                return datetime.utcfromtimestamp(epoch).strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
+        elif base_type == 'date':
+            epoch = to_epoch(value)
+            if epoch is not None:
+                return datetime.utcfromtimestamp(epoch).strftime('%Y-%m-%d')
+    except (ValueError, OverflowError, OSError):
+        pass
+    return value
+
+
+def to_epoch(value):
+    """
+    Returns the epoch seconds of a numeric value in seconds or milliseconds, or None if not numeric
+    """
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, str):
+        if not INTEGER.match(value):
+            return None
+        value = int(value)
+    if not isinstance(value, (int, float)):
+        return None
+    return value / 1000 if abs(value) >= EPOCH_MILLIS_THRESHOLD else value
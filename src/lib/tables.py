@@ -1,10 +1,32 @@
 
 import os
 import re
+from datetime import datetime
 from collections.abc import Mapping
 
 # pylint: disable=invalid-name, line-too-long
 
+# partition keys filled from the firehose timestamp, as (key names, firehose timestamp format, projection properties).
+# date projections range from the table creation, formatted with the start strftime format
+TIMESTAMP_PARTITION_KEYS = [
+    (('year', 'yyyy'), 'yyyy', {'type': 'date', 'format': 'yyyy', 'interval': '1', 'interval.unit': 'YEARS', 'start': '%Y'}),
+    (('month', 'mm'), 'MM', {'type': 'integer', 'range': '1,12', 'digits': '2'}),
+    (('day', 'dd'), 'dd', {'type': 'integer', 'range': '1,31', 'digits': '2'}),
+    (('hour', 'hh'), 'HH', {'type': 'integer', 'range': '0,23', 'digits': '2'}),
+    (('minute', 'min'), 'mm', {'type': 'integer', 'range': '0,59', 'digits': '2'}),
+    (('date', 'day', 'dt'), 'yyyyMMdd', {'type': 'date', 'format': 'yyyyMMdd', 'interval': '1', 'interval.unit': 'DAYS', 'start': '%Y%m%d'}),
+    (('time', 'tm'), 'HHmm', {'type': 'integer', 'range': '0,2359', 'digits': '4'}),
+]
+
+def get_timestamp_partition_key(partition_key: str):
+    """
+    Returns the (key names, firehose timestamp format, projection properties) matching a partition key, or None
+    """
+    for timestamp_key in TIMESTAMP_PARTITION_KEYS:
+        if partition_key.lower() in timestamp_key[0]:
+            return timestamp_key
+    return None
+
 class GlueTable(Mapping):
     """
     Simply wraps the glue table params
@@ -60,6 +82,45 @@ class GlueTable(Mapping):
         """
         return self._storage.get('PartitionKeys', [])
 
+    def get_partition_schema(self):
+        """
+        Returns the firehose partition schema of the table, either its parameter or generated
+        from the partition keys filled from the firehose timestamp
+        """
+        partition_schema = self.get_params().get_partition_schema()
+        if partition_schema:
+            return partition_schema
+        partition_schema_elements: list = []
+        for partition_key in [key.get('Name') for key in self.get_partition_keys()]:
+            timestamp_key = get_timestamp_partition_key(partition_key)
+            if timestamp_key:
+                partition_schema_elements.append(f'{partition_key}=' + '!{timestamp:' + timestamp_key[1] + '}')
+        return '/'.join(partition_schema_elements)
+
+    def get_partition_projection(self):
+        """
+        Returns the Athena partition projection parameters of the table, or an empty dict if its partitions can't be
+        projected, that is if it has a partition schema parameter or a partition key not filled from the firehose timestamp
+        """
+        partition_keys = [key.get('Name') for key in self.get_partition_keys()]
+        if not partition_keys or self.get_params().get_partition_schema():
+            return {}
+        created = self._storage.get('CreateTime') or datetime.utcnow()
+        projection = {'projection.enabled': 'true'}
+        for partition_key in partition_keys:
+            timestamp_key = get_timestamp_partition_key(partition_key)
+            if not timestamp_key:
+                return {}
+            for name, value in timestamp_key[2].items():
+                if name == 'start':
+                    projection[f'projection.{partition_key}.range'] = created.strftime(value) + ',NOW'
+                else:
+                    projection[f'projection.{partition_key}.{name}'] = value
+        projection['storage.location.template'] = self.get_table_location() + ''.join(
+            f'/{partition_key}=${{{partition_key}}}' for partition_key in partition_keys
+        )
+        return projection
+
     def is_symlinked(self):
         """
         Returns True if this table is using a simlink input format
@@ -77,15 +138,27 @@ class GlueTable(Mapping):
             prefix = self.get_params().get_firehose_prefix() + prefix + self.get_params().get_firehose_suffix()
         return prefix[:-1] if prefix[-1:] == '/' else prefix
 
-    def get_compaction_bucketing(self):
+    def get_compaction_bucketing(self, bucket_count: int = None):
         """
         Returns a SQL statement to use when compacting the partition in buckets
-        If no parameter is specified, it defaults to one bucket by the first column in the schema
+        If no parameter is specified, it defaults to bucket_count buckets, or one, by the first column in the schema
         """
         columns = self.get_params().get_compaction_bucketing_columns()
         if not columns:
             columns = [self.get_storage_descriptor().get('Columns')[0]['Name']]
-        return 'bucketed_by = ARRAY[' + ','.join([f"'{column}'" for column in columns]) +'], bucket_count = ' + self.get_params().get_compaction_bucketing_count()
+        count = self.get_compaction_bucket_count(0) if self.get_params().get_compaction_bucketing_count() else bucket_count or 1
+        return 'bucketed_by = ARRAY[' + ','.join([f"'{column}'" for column in columns]) +'], bucket_count = ' + str(count)
+
+    def get_compaction_bucket_count(self, size: int) -> int:
+        """
+        Returns the number of buckets writing size bytes in files of about the target file size,
+        or the bucket count set on the table
+        """
+        count = self.get_params().get_compaction_bucketing_count()
+        if count:
+            return max(1, int(count))
+        target = max(1, self.get_params().get_compaction_file_mb()) * 1024 * 1024
+        return max(1, -(-size // target))
 
     def get_compaction_sorting(self):
         """
@@ -160,8 +233,38 @@ class GlueTableParams(Mapping):
     def get_processors_lambda_buffer_seconds(self):
         return self.get('firehose_processors_lambda_buffer_seconds', '60')
 
+    def is_processors_projection(self):
+        return self.get('firehose_processors_projection', "").lower() in ('true', 'yes')
+
+    def is_partition_projection(self):
+        return self.get('firehose_partition_projection', "").lower() in ('true', 'yes')
+
+    def is_projection_enabled(self):
+        return self._storage.get('projection.enabled', "").lower() == 'true'
+
+    def get_partition_idle_seconds(self):
+        return self.get_int('firehose_partition_idle_seconds', 0)
+
+    def get_compaction_min_objects(self):
+        return self.get_int('firehose_compaction_min_objects', 2)
+
+    def get_compaction_min_bytes(self):
+        return self.get_int('firehose_compaction_min_bytes', 0)
+
+    def get_compaction_max_partitions(self):
+        return min(self.get_int('firehose_compaction_max_partitions', 100), 100)
+
+    def get_compaction_grace_seconds(self):
+        return self.get_int('firehose_compaction_grace_seconds', 0)
+
+    def get_compaction_max_deltas(self):
+        return self.get_int('firehose_compaction_max_deltas', 4)
+
     def get_compaction_bucketing_count(self):
-        return self.get('firehose_compaction_bucketing_count', '1')
+        return self.get('firehose_compaction_bucketing_count')
+
+    def get_compaction_file_mb(self):
+        return self.get_int('firehose_compaction_file_mb', 256)
 
     def get_compaction_bucketing_columns(self): 
         columns = self.get('firehose_compaction_bucketing_columns')
@@ -0,0 +1,20 @@
+"""
+Unit tests of the pure helpers, run from the repository root with the runtime requirements installed:
+
+    make test
+"""
+import os
+import sys
+
+# the lambda code imports its modules from src, and creates its aws clients at import without calling them
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+for name, value in {
+        'AWS_DEFAULT_REGION': 'us-east-1',
+        'AWS_XRAY_SDK_ENABLED': 'false',
+        'DATA_BUCKET': 'data',
+        'TMP_DATABASE': 'tmp',
+        'COMPACTED_PARTITIONS': 'compacted-partitions',
+        'ATHENA_QUERIES': 'athena-queries',
+        'GLUE_TABLES_LOCATOR': 'tables-locator',
+        'GLUE_PARTITIONS_MAPPER': 'partitions-mapper'}.items():
+    os.environ.setdefault(name, value)
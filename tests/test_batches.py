@@ -0,0 +1,43 @@
+import time
+
+from lib.batches import Limits, FIREHOSE_LIMITS, pack, retry_failed
+
+
+def test_pack_honours_the_count_and_size_limits():
+    limits = Limits(count=3, size=10, record_size=10)
+    assert list(pack(['aaaa', 'bbbb', 'cc', 'd', 'e', 'f', 'g'], limits)) == [['aaaa', 'bbbb', 'cc'], ['d', 'e', 'f'], ['g']]
+    assert list(pack(['aaaaaa', 'bbbbb'], limits)) == [['aaaaaa'], ['bbbbb']]
+
+
+def test_pack_leaves_oversized_items_out():
+    oversized: list = []
+    limits = Limits(count=10, size=10, record_size=4)
+    assert list(pack(['aa', 'bbbbb', 'cc'], limits, oversized=oversized)) == [['aa', 'cc']]
+    assert oversized == ['bbbbb']
+
+
+def test_pack_firehose_records_by_size():
+    records = [b'x' * (1000 * 1024)] * 5
+    assert [len(batch) for batch in pack(records, FIREHOSE_LIMITS)] == [4, 1]
+    assert list(pack([], FIREHOSE_LIMITS)) == []
+
+
+def test_retry_failed_resends_only_the_failed_items():
+    sent: list = []
+    def send(items):
+        sent.append(list(items))
+        return [item for item in items if item == 'b' and len(sent) < 3]
+    assert retry_failed(send, ['a', 'b', 'c'], time.monotonic() + 60, base=0.001) == []
+    assert sent == [['a', 'b', 'c'], ['b'], ['b']]
+
+
+def test_retry_failed_gives_up_after_attempts_or_deadline():
+    def send(items):
+        return items
+    assert retry_failed(send, ['a'], time.monotonic() + 60, attempts=2, base=0.001) == ['a']
+    calls: list = []
+    def count(items):
+        calls.append(items)
+        return items
+    assert retry_failed(count, ['a'], time.monotonic() - 1) == ['a']
+    assert len(calls) == 1
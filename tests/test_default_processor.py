@@ -0,0 +1,48 @@
+import base64
+import json
+
+import pytest
+
+from data import default_processor
+
+METADATA = {'record_id': 'r1', 'timestamp': 1571300000000}
+
+
+def transform(raw: bytes) -> dict:
+    return default_processor.transform({
+        'recordId': 'r1',
+        'approximateArrivalTimestamp': 1571300000000,
+        'data': base64.b64encode(raw).decode('utf-8')
+    })
+
+
+@pytest.mark.parametrize('raw, expected', [
+    (b'{"a":1}', {'a': 1, 'firehose': METADATA}),
+    (b' {"a": {"b": [1, "}{"]}}\n', {'a': {'b': [1, '}{']}, 'firehose': METADATA}),
+    (b'{}', {'firehose': METADATA}),
+    (b'{"firehose": {"old": true}, "a": 1}', {'a': 1, 'firehose': METADATA})
+])
+def test_add_metadata(raw, expected):
+    result = transform(raw)
+    assert result['result'] == 'Ok'
+    assert json.loads(base64.b64decode(result['data'])) == expected
+
+
+@pytest.mark.parametrize('raw', [
+    b'{"a":1},{"b":2}',
+    b'{"a":1} x {"b":2}',
+    b'{"a":1} {"b":2}',
+    b'{"a":1,}',
+    b'[{"a":1}]',
+    b'{"a":1'
+])
+def test_malformed_records_fail(raw):
+    result = transform(raw)
+    assert result['result'] == 'ProcessingFailed'
+    assert base64.b64decode(result['data']) == raw
+
+
+def test_splice_appends_the_last_member():
+    assert default_processor.splice(b'{"a": 1} ', b'{"b": 2}') == b'{"a": 1, "firehose": {"b": 2}}'
+    assert default_processor.splice(b'{ }', b'{}') == b'{"firehose": {}}'
+    assert default_processor.splice(b'\xff\xfe{\x00}\x00', b'{}') is None
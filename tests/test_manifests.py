@@ -0,0 +1,28 @@
+from lib.manifests import render_manifest
+
+OUTPUTS = [
+    's3://data/firehose/events/compacted=1/tmp0/dt=2019-10-17',
+    's3://data/firehose/events/compacted=2/tmp1/dt=2019-10-17'
+]
+
+
+def test_outputs_then_sorted_objects():
+    item = {
+        'outputs': OUTPUTS,
+        'objects': {'s3://data/firehose/events/dt=2019-10-17/b', 's3://data/firehose/events/dt=2019-10-17/a'}
+    }
+    assert render_manifest(item) == OUTPUTS + [
+        's3://data/firehose/events/dt=2019-10-17/a',
+        's3://data/firehose/events/dt=2019-10-17/b'
+    ]
+
+
+def test_partitions_not_compacted_yet_list_their_objects():
+    assert render_manifest({'objects': {'s3://data/firehose/events/dt=2019-10-17/a'}}) == ['s3://data/firehose/events/dt=2019-10-17/a']
+    assert render_manifest({'outputs': OUTPUTS}) == OUTPUTS
+    assert render_manifest({}) == []
+
+
+def test_listed_partitions_list_their_source_prefix():
+    item = {'outputs': OUTPUTS, 'listed': True, 'source': 's3://data/firehose/events/dt=2019-10-17'}
+    assert render_manifest(item) == ['s3://data/firehose/events/dt=2019-10-17/']
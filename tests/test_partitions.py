@@ -0,0 +1,46 @@
+from lib.partitions import OPENED, CLOSED, is_touch, read_all
+
+OPENED_ITEM = {'state': OPENED, 'version': 2, 'updated': '2019-10-17T10:00:00', 'touched': '2019-10-17T10:00:00'}
+
+
+def test_touch_changes_neither_state_nor_version():
+    assert is_touch(OPENED_ITEM, dict(OPENED_ITEM, touched='2019-10-17T10:05:00'))
+
+
+def test_close_is_not_a_touch_whatever_the_timestamps():
+    # a close computed before a concurrent touch was written
+    closed = dict(OPENED_ITEM, state=CLOSED, version=3, updated='2019-10-17T10:04:00', touched='2019-10-17T10:05:00')
+    assert not is_touch(dict(OPENED_ITEM, touched='2019-10-17T10:05:00'), closed)
+
+
+def test_reopen_and_insert_are_not_touches():
+    closed = dict(OPENED_ITEM, state=CLOSED, version=3)
+    assert not is_touch(closed, dict(OPENED_ITEM, version=4))
+    assert not is_touch({}, OPENED_ITEM)
+
+
+def pages(*items):
+    """
+    A paginated read serving a page of items per call, recording the calls
+    """
+    calls: list = []
+    def read(**kwargs):
+        calls.append(kwargs)
+        page = len(calls) - 1
+        response = {'Items': items[page]}
+        if page < len(items) - 1:
+            response['LastEvaluatedKey'] = {'page': page}
+        return response
+    return read, calls
+
+
+def test_read_all_reads_every_page():
+    read, calls = pages([1, 2], [], [3])
+    assert read_all(read, IndexName='index') == [1, 2, 3]
+    assert calls[2] == {'IndexName': 'index', 'ExclusiveStartKey': {'page': 1}}
+
+
+def test_read_all_stops_at_limit():
+    read, calls = pages([1, 2], [3, 4], [5])
+    assert read_all(read, limit=3) == [1, 2, 3]
+    assert len(calls) == 2
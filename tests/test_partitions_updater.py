@@ -0,0 +1,31 @@
+from control.partitions_updater import is_changed
+
+STORAGE = {
+    'Columns': [{'Name': 'a', 'Type': 'string'}],
+    'Location': 's3://data/firehose/events/dt=2019-10-17',
+    'InputFormat': 'org.apache.hadoop.mapred.TextInputFormat',
+    'OutputFormat': 'org.apache.hadoop.hive.ql.io.HiveIgnoreKeyTextOutputFormat',
+    'Compressed': False,
+    'SerdeInfo': {'SerializationLibrary': 'org.openx.data.jsonserde.JsonSerDe', 'Parameters': {}},
+    'Parameters': {},
+    'StoredAsSubDirectories': False
+}
+
+
+def test_members_filled_in_by_glue_are_not_changes():
+    registered = dict(
+        STORAGE,
+        Columns=[{'Name': 'a', 'Type': 'string', 'Parameters': {}}],
+        SerdeInfo={'SerializationLibrary': 'org.openx.data.jsonserde.JsonSerDe', 'Parameters': {'serialization.format': '1'}},
+        Parameters={'classification': 'json'},
+        NumberOfBuckets=-1,
+        SortColumns=[]
+    )
+    assert not is_changed(registered, STORAGE)
+
+
+def test_location_formats_and_serde_are_changes():
+    assert is_changed(dict(STORAGE, Location='s3://data/firehose/events/dt=2019-10-16'), STORAGE)
+    assert is_changed(dict(STORAGE, InputFormat='org.apache.hadoop.hive.ql.io.parquet.MapredParquetInputFormat'), STORAGE)
+    assert is_changed(dict(STORAGE, SerdeInfo={'SerializationLibrary': 'org.apache.hive.hcatalog.data.JsonSerDe'}), STORAGE)
+    assert is_changed({}, STORAGE)
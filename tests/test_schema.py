@@ -0,0 +1,51 @@
+import json
+
+import pytest
+
+from lib.schema import coerce, project
+
+
+@pytest.mark.parametrize('value, column_type, expected', [
+    ('42', 'bigint', 42),
+    (' -7 ', 'int', -7),
+    (3.0, 'int', 3),
+    (3.5, 'int', 3.5),
+    (True, 'int', 1),
+    ('4.2', 'double', 4.2),
+    (False, 'float', 0.0),
+    ('12.30', 'decimal(10,2)', '12.30'),
+    (12.3, 'decimal(10,2)', 12.3),
+    ('TRUE', 'boolean', True),
+    ('yes', 'boolean', 'yes'),
+    (12, 'string', '12'),
+    (True, 'varchar(5)', 'true'),
+    (1571306400, 'timestamp', '2019-10-17 10:00:00.000'),
+    ('1571306400123', 'timestamp', '2019-10-17 10:00:00.123'),
+    (1571306400, 'date', '2019-10-17'),
+    ('2019-10-17', 'date', '2019-10-17'),
+    ('abc', 'bigint', 'abc'),
+    (None, 'bigint', None),
+    ({'a': 1}, 'string', {'a': 1})
+])
+def test_coerce(value, column_type, expected):
+    coerced = coerce(value, column_type)
+    assert coerced == expected
+    assert type(coerced) is type(expected)
+
+
+@pytest.mark.parametrize('value, column_type', [
+    ('nan', 'double'),
+    ('inf', 'float'),
+    (float('nan'), 'double'),
+    (float('-inf'), 'string'),
+    ('1e400', 'double')
+])
+def test_coerce_drops_non_finite_numbers(value, column_type):
+    assert coerce(value, column_type) is None
+
+
+def test_project_keeps_the_declared_columns_as_valid_json():
+    columns = {'id': 'bigint', 'user_name': 'string', 'score': 'double'}
+    projected = project({'ID': '1', 'user.name': 7, 'score': 'NaN', 'extra': 1}, columns)
+    assert projected == {'ID': 1, 'user.name': '7', 'score': None}
+    assert json.loads(json.dumps(projected, allow_nan=False)) == projected
@@ -0,0 +1,37 @@
+import pytest
+
+from lib.tables import GlueTable
+
+MB = 1024 * 1024
+
+
+def table(**params) -> GlueTable:
+    return GlueTable({
+        'Parameters': params,
+        'StorageDescriptor': {'Columns': [{'Name': 'id', 'Type': 'string'}]}
+    })
+
+
+@pytest.mark.parametrize('size, expected', [
+    (0, 1),
+    (1, 1),
+    (256 * MB, 1),
+    (256 * MB + 1, 2),
+    (10 * 1024 * MB, 40)
+])
+def test_bucket_count_writes_files_of_the_target_size(size, expected):
+    assert table().get_compaction_bucket_count(size) == expected
+
+
+def test_bucket_count_of_the_table_params():
+    assert table(firehose_compaction_file_mb='64').get_compaction_bucket_count(256 * MB) == 4
+    assert table(firehose_compaction_bucketing_count='8').get_compaction_bucket_count(1) == 8
+    assert table(firehose_compaction_bucketing_count='0').get_compaction_bucket_count(512 * MB) == 1
+    assert table(firehose_compaction_file_mb='0').get_compaction_bucket_count(3 * MB) == 3
+
+
+def test_bucketing_statement():
+    assert table().get_compaction_bucketing(3) == "bucketed_by = ARRAY['id'], bucket_count = 3"
+    assert table(firehose_compaction_bucketing_columns='a, b', firehose_compaction_bucketing_count='2').get_compaction_bucketing(3) == \
+        "bucketed_by = ARRAY['a','b'], bucket_count = 2"
+    assert table(firehose_compaction_bucketing_count='0').get_compaction_bucketing() == "bucketed_by = ARRAY['id'], bucket_count = 1"